@@ -1,8 +1,12 @@
-from openai import OpenAI
-from config import DEEPSEEK_API
-from utils import parse_markdown_json
+import hashlib
+import json
+import os
+import re
+import time
+import config
+from utils import parse_markdown_json, local_state_path, chunk_page_items, LOCAL_STATE_DIR
 
-DEEPSEEK_CLIENT = OpenAI(api_key=DEEPSEEK_API, base_url="https://api.deepseek.com")
+_deepseek_client = None
 # Note: DeepSeek has an output limit of 8192, so need to estimate it to control the input.
 PROMPT_FIXED_OVERHEAD = 2000  # Assumed size of "common parts" of the prompt. No assertion over it for now.
 PROMPT_LENGTH_LIMIT = 8000
@@ -33,6 +37,17 @@ PROMPT_LENGTH_LIMIT = 8000
 # ]
 
 
+def get_deepseek_client():
+    """
+    Return the shared DeepSeek (OpenAI-compatible) client, building it on first use.
+    """
+    global _deepseek_client
+    if _deepseek_client is None:
+        from openai import OpenAI
+        _deepseek_client = OpenAI(api_key=config.DEEPSEEK_API, base_url="https://api.deepseek.com")
+    return _deepseek_client
+
+
 def build_batch_prompt(page_ids, page_texts, categories):
     """
     Build two strings: one for the system role and one for the user role.
@@ -40,17 +55,13 @@ def build_batch_prompt(page_ids, page_texts, categories):
     - page_ids: list of unique identifiers (matching the texts)
     - page_texts: list of texts that need analysis
     - categories: list of categories (label, description) for classification
-    
-    The AI is asked to return a JSON array of length = len(page_texts).
-    Each element in the array corresponds to one (page_id, page_text) pair.
-    The structure in each array element should be:
-    {
-      "page_id": "...",
-      "category": "...",
-      "tags": [...],
-      "has_lexical_suggestion": false,
-      "lexical_suggestion": ""
-    }
+
+    Items are numbered 1..N instead of being labelled with their page_id, and
+    the AI is asked for a compact JSON array with one positional row per item:
+      [index, "category", ["tag", ...]]
+      [index, "category", ["tag", ...], "lexical suggestion"]   # only when there is one
+    Use decode_batch_results to map the rows back to full result dicts.
+    page_ids is unused here; it's kept so the call mirrors decode_batch_results.
     """
 
     # Create the category lines for the prompt
@@ -61,64 +72,90 @@ def build_batch_prompt(page_ids, page_texts, categories):
 
     # System content: overarching instructions
     system_content = (
-        "You are an AI text analysis assistant. You will receive multiple short items in a single request. "
-        "For each item, you must return ONLY valid JSON with the following fields: "
-        "\"page_id\", \"category\", \"tags\", \"has_lexical_suggestion\", and \"lexical_suggestion\". "
-        "No extra commentary, just the JSON. "
-        "The final response must be a JSON array of objects, one object per input item."
+        "You are an AI text analysis assistant. You will receive multiple short numbered items in a single request. "
+        "You must return ONLY a compact JSON array with one row per input item, "
+        "each row being [index, category, tags] or [index, category, tags, suggestion]. "
+        "No extra commentary, no whitespace formatting, just the JSON."
     )
 
-    # Build a multi-item user prompt
-    # We'll list each item with an index, the page_id, and the text.
+    # Build a multi-item user prompt: each item is just its index and text
     items_str_list = []
-    for i, (pid, text) in enumerate(zip(page_ids, page_texts), start=1):
-        items_str_list.append(f"{i}) page_id: {pid}\n   text: {text}")
+    for i, text in enumerate(page_texts, start=1):
+        items_str_list.append(f"{i}) {text}")
 
-    items_block = "\n\n".join(items_str_list)
+    items_block = "\n".join(items_str_list)
 
     # User content: instructions + the items + the required output structure
     user_content = f"""
-Please analyze each of the following items and categorize them. Here are the requirements:
+Analyze and categorize each item below. For each item, output one row [index, category, tags] or [index, category, tags, suggestion]:
 
-1. "page_id": The same page_id as provided in the input.
-2. "category": Must be one of the known labels below (or "Other" if none match).
-3. "tags": A list of short keywords describing the text.
-4. "has_lexical_suggestion": A boolean, true if the text likely has spelling/grammar/transcription issues.
-5. "lexical_suggestion": If has_lexical_suggestion is true, provide a corrected version in the original language; otherwise, leave it empty.
+1. index: The item's number as given in the input.
+2. category: Must be one of the known labels below (or "Other" if none match).
+3. tags: A list of short keywords describing the text.
+4. suggestion: Only if the text likely has spelling/grammar/transcription issues, a corrected version in the original language. Omit it otherwise.
 
 Here are the possible categories (label → description):
 {categories_str}
 
-Below are the items to analyze (page_id and text). Return your results as a JSON array of length {len(page_texts)}, 
-where each element is a JSON object matching the format shown. 
-The Nth object corresponds to the Nth item:
-
+Items ({len(page_texts)}):
 {items_block}
 
-Your final response must be ONLY the JSON array in this structure (no extra text). 
-For example, if we had 2 items, it would look like:
-
-[
-  {{
-    "page_id": "...",
-    "category": "...",
-    "tags": ["...", "..."],
-    "has_lexical_suggestion": false,
-    "lexical_suggestion": ""
-  }},
-  {{
-    "page_id": "...",
-    "category": "...",
-    "tags": ["...", "..."],
-    "has_lexical_suggestion": false,
-    "lexical_suggestion": ""
-  }}
-]
+Your final response must be ONLY the JSON array of {len(page_texts)} rows (no extra text). For example:
+[[1,"Food",["ramen","review"]],[2,"Other",["todo"],"Corrected text"]]
 """.strip()
 
     return system_content, user_content
 
 
+def decode_batch_results(batch_ids, batch_rows, categories=None):
+    """
+    Map the compact rows returned for a batch (see build_batch_prompt) back to full result dicts:
+      {
+        "page_id": "18c81f71-36d9-8029-a648-d1a99893724b",
+        "category": "Food",
+        "tags": ["tag1", "tag2"],
+        "has_lexical_suggestion": false,
+        "lexical_suggestion": "",
+        "source": "deepseek"
+      }
+
+    Rows with an out-of-range or repeated index, or a malformed shape, are dropped;
+    a category outside `categories` becomes "Other". A reply that couldn't be parsed
+    as JSON yields no results; those pages stay to_analyse.
+    """
+    if not isinstance(batch_rows, list):
+        print("Warning: AI reply is not a JSON array, skipping this batch.")
+        return []
+
+    known_labels = None if categories is None else {cat["label"] for cat in categories}
+    results = []
+    seen = set()
+    for row in batch_rows:
+        if not isinstance(row, list) or len(row) < 3:
+            continue
+        index, category, tags = row[0], row[1], row[2]
+        suggestion = row[3] if len(row) > 3 and isinstance(row[3], str) else ""
+        if type(index) is not int or not 1 <= index <= len(batch_ids) or index in seen:  # bool is an int subclass
+            continue
+        if not isinstance(category, str) or not isinstance(tags, list):
+            continue
+        seen.add(index)
+        if known_labels is not None and category not in known_labels:
+            category = "Other"
+        results.append({
+            "page_id": batch_ids[index - 1],
+            "category": category,
+            "tags": [str(t) for t in tags],
+            "has_lexical_suggestion": bool(suggestion.strip()),
+            "lexical_suggestion": suggestion.strip(),
+            "source": "deepseek",
+        })
+
+    if len(results) < len(batch_ids):
+        print(f"Warning: AI returned {len(results)} valid rows for {len(batch_ids)} items; the rest stay to_analyse.")
+    return results
+
+
 def send_to_deepseek_ai(prompt):
     """
     Form a JSON payload to the AI (DeepSeek) for:
@@ -131,7 +168,7 @@ def send_to_deepseek_ai(prompt):
     # if max(map(len, prompt)) > PROMPT_LENGTH_LIMIT:
     #     raise ValueError(f"Prompt length (either system or user) exceeds {PROMPT_LENGTH_LIMIT}")
 
-    response = DEEPSEEK_CLIENT.chat.completions.create(
+    response = get_deepseek_client().chat.completions.create(
         model="deepseek-chat",
         messages=[
             {"role": "system", "content": system_str},
@@ -142,4 +179,280 @@ def send_to_deepseek_ai(prompt):
     )
     markdown_text = response.choices[0].message.content
     data = parse_markdown_json(markdown_text)
-    return data
\ No newline at end of file
+    return data
+
+# -----------------
+# Category routing
+# -----------------
+
+# With many categories, listing every label and description in each batch prompt eats
+# the input budget. Categories are then split into groups: a first, cheap pass routes
+# each note to a group (showing only group names and a few member labels), and the normal
+# classification prompt is built per group with just that group's categories.
+# With more than CATEGORY_GROUP_SIZE groups, groups are bundled and routing recurses
+# (bundle first, then group), so no routing prompt offers more than CATEGORY_GROUP_SIZE options.
+CATEGORY_ROUTING_MIN_CATEGORIES = 20  # Below this, the single-stage prompt is used
+CATEGORY_GROUP_SIZE = 10              # Max categories per group, and max options per routing prompt
+CATEGORY_ROUTING_SUMMARY_LABELS = 5   # Labels shown per option in the routing prompt
+
+
+def _category_words(category):
+    return set(re.findall(r"\w+", f'{category["label"]} {category["description"]}'.lower()))
+
+
+def _split_by_similarity(words, size):
+    """
+    Greedily split items (given as word sets) into chunks of up to `size` by word overlap.
+    Returns a list of index lists.
+    """
+    ungrouped = list(range(len(words)))
+    chunks = []
+    while ungrouped:
+        seed = ungrouped.pop(0)
+
+        def similarity(i):
+            union = words[seed] | words[i]
+            return len(words[seed] & words[i]) / len(union) if union else 0.0
+
+        members = [seed] + sorted(ungrouped, key=similarity, reverse=True)[:size - 1]
+        ungrouped = [i for i in ungrouped if i not in members]
+        chunks.append(members)
+    return chunks
+
+
+def group_categories(categories):
+    """
+    Group categories for two-stage routing.
+
+    Uses the "group" field from the Category sheet's "Group" column when any category has
+    one (categories left blank join an "Other" group); a group with more than
+    CATEGORY_GROUP_SIZE categories is split by similarity into "Name (1)", "Name (2)", ...
+    Otherwise, with at least CATEGORY_ROUTING_MIN_CATEGORIES categories, groups of up to
+    CATEGORY_GROUP_SIZE are derived greedily by word overlap between labels and descriptions.
+
+    Returns {group name: [category, ...]}, or None when routing isn't worthwhile.
+    """
+    if any(cat.get("group") for cat in categories):
+        manual = {}
+        for cat in categories:
+            manual.setdefault(cat.get("group") or "Other", []).append(cat)
+        if len(manual) < 2 and len(categories) <= CATEGORY_GROUP_SIZE:
+            return None
+        groups = {}
+        for name, members in manual.items():
+            if len(members) <= CATEGORY_GROUP_SIZE:
+                groups[name] = members
+                continue
+            chunks = _split_by_similarity([_category_words(cat) for cat in members], CATEGORY_GROUP_SIZE)
+            for k, chunk in enumerate(chunks, start=1):
+                groups[f"{name} ({k})"] = [members[i] for i in chunk]
+        return groups
+
+    if len(categories) < CATEGORY_ROUTING_MIN_CATEGORIES:
+        return None
+
+    chunks = _split_by_similarity([_category_words(cat) for cat in categories], CATEGORY_GROUP_SIZE)
+    return {f"G{k}": [categories[i] for i in chunk] for k, chunk in enumerate(chunks, start=1)}
+
+
+def summarize_groups(groups):
+    """
+    Bounded description of a set of groups for the routing prompt: up to
+    CATEGORY_ROUTING_SUMMARY_LABELS labels, taken in turn from each group, plus a count of the rest.
+    """
+    queues = [[cat["label"] for cat in members] for members in groups.values()]
+    labels = []
+    while any(queues) and len(labels) < CATEGORY_ROUTING_SUMMARY_LABELS:
+        for queue in queues:
+            if queue and len(labels) < CATEGORY_ROUTING_SUMMARY_LABELS:
+                labels.append(queue.pop(0))
+    rest = sum(len(queue) for queue in queues)
+    return ", ".join(labels) + (f" (+{rest} more)" if rest else "")
+
+
+def build_routing_prompt(page_texts, summaries):
+    """
+    Build the (system, user) prompt of the routing pass: the AI picks one option per item
+    and answers with a compact JSON array of [index, "option"] rows.
+    summaries is {option name: summary} (see summarize_groups), so the prompt size
+    is bounded by the number of options, not the number of categories.
+    """
+    groups_str = "\n".join(f'• "{name}": {summary}' for name, summary in summaries.items())
+
+    system_content = (
+        "You are an AI text routing assistant. You will receive multiple short numbered items. "
+        "You must return ONLY a compact JSON array with one [index, group] row per input item. "
+        "No extra commentary, just the JSON."
+    )
+
+    items_block = "\n".join(f"{i}) {text}" for i, text in enumerate(page_texts, start=1))
+
+    user_content = f"""
+For each item, choose the group whose categories fit it best.
+
+Groups (name: example categories):
+{groups_str}
+
+Items ({len(page_texts)}):
+{items_block}
+
+Your final response must be ONLY the JSON array of {len(page_texts)} rows (no extra text). For example:
+[[1,"{next(iter(summaries))}"],[2,"{list(summaries)[-1]}"]]
+""".strip()
+
+    return system_content, user_content
+
+
+def decode_routing_results(batch_ids, batch_rows, options):
+    """
+    Map [index, "option"] rows back to {page_id: option name}.
+    Items without a valid row are left out (they stay to_analyse).
+    """
+    if not isinstance(batch_rows, list):
+        print("Warning: AI routing reply is not a JSON array, skipping this batch.")
+        return {}
+    routes = {}
+    for row in batch_rows:
+        if not isinstance(row, list) or len(row) < 2:
+            continue
+        index, option = row[0], row[1]
+        if isinstance(index, int) and 1 <= index <= len(batch_ids) and isinstance(option, str) and option in options:
+            routes.setdefault(batch_ids[index - 1], option)
+    return routes
+
+
+def _routing_options(groups):
+    """
+    {option name: {group name: members}}: one option per group, or with more than
+    CATEGORY_GROUP_SIZE groups, at most CATEGORY_GROUP_SIZE bundles of similar groups.
+    """
+    if len(groups) <= CATEGORY_GROUP_SIZE:
+        return {name: {name: members} for name, members in groups.items()}
+    names = list(groups)
+    words = [set().union(*(_category_words(cat) for cat in groups[name])) for name in names]
+    bundle_size = -(-len(names) // CATEGORY_GROUP_SIZE)
+    return {f"B{k}": {names[i]: groups[names[i]] for i in chunk}
+            for k, chunk in enumerate(_split_by_similarity(words, bundle_size), start=1)}
+
+
+def route_notes(page_ids, page_texts, groups, max_chars_per_batch):
+    """
+    Run the routing pass over all notes (recursing through bundles when there are many groups).
+    Returns {group name: (page_ids, page_texts)} for the groups that received notes.
+    """
+    options = _routing_options(groups)
+    summaries = {name: summarize_groups(option_groups) for name, option_groups in options.items()}
+    routes = {}
+    for batch_ids, batch_texts in chunk_page_items(page_ids, page_texts, max_chars_per_batch):
+        routes.update(decode_routing_results(batch_ids, send_to_deepseek_ai(build_routing_prompt(batch_texts, summaries)), summaries))
+
+    routed = {}
+    for name, option_groups in options.items():
+        ids = [page_id for page_id, text in zip(page_ids, page_texts) if routes.get(page_id) == name]
+        if not ids:
+            continue
+        texts = [text for page_id, text in zip(page_ids, page_texts) if routes.get(page_id) == name]
+        if len(option_groups) == 1:
+            routed[next(iter(option_groups))] = (ids, texts)
+        else:
+            routed.update(route_notes(ids, texts, option_groups, max_chars_per_batch))
+    if len(routes) < len(page_ids):
+        print(f"Warning: {len(page_ids) - len(routes)} notes could not be routed; they stay to_analyse.")
+    return routed
+
+
+# ----------
+# Checkpoint
+# ----------
+
+# Each worker (lease owner) appends to and clears only its own file; all files are read,
+# so a restarted worker also resumes what a crashed one had paid for.
+AI_CHECKPOINT_PREFIX = "ai_checkpoint"
+AI_CHECKPOINT_STALE_SECONDS = 24 * 3600  # Files of crashed workers untouched this long are removed
+
+
+def ai_checkpoint_path(owner=None):
+    if owner is None:
+        return local_state_path(f"{AI_CHECKPOINT_PREFIX}.jsonl")
+    safe_owner = re.sub(r"[^\w.-]", "_", owner)  # host:pid:id → usable as a file name
+    return local_state_path(f"{AI_CHECKPOINT_PREFIX}.{safe_owner}.jsonl")
+
+
+def _ai_checkpoint_files():
+    local_state_path("")  # make sure the directory exists
+    return [os.path.join(LOCAL_STATE_DIR, name) for name in sorted(os.listdir(LOCAL_STATE_DIR))
+            if name.startswith(AI_CHECKPOINT_PREFIX + ".") and name.endswith(".jsonl")]
+
+
+def text_fingerprint(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def load_ai_checkpoint():
+    """
+    Load results checkpointed by unfinished google_sheets_to_ai runs (of any worker).
+    Returns {page_id: (text fingerprint, result dict)}.
+    """
+    checkpoint = {}
+    for path in _ai_checkpoint_files():
+        try:
+            with open(path, encoding="utf-8") as f:
+                lines = f.readlines()
+        except OSError:
+            continue  # cleared by its worker meanwhile
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # a line cut off by a crash mid-write
+            result = dict(entry["result"])
+            result.setdefault("source", "deepseek")  # checkpoints only ever hold DeepSeek results
+            checkpoint[entry["page_id"]] = (entry["text_hash"], result)
+    return checkpoint
+
+
+def append_ai_checkpoint(page_ids, page_texts, results, owner=None):
+    """
+    Append one batch's parsed results to this worker's checkpoint, flushed to disk before returning.
+    """
+    texts = dict(zip(page_ids, page_texts))
+    with open(ai_checkpoint_path(owner), "a", encoding="utf-8") as f:
+        for result in results:
+            entry = {
+                "page_id": result["page_id"],
+                "text_hash": text_fingerprint(texts[result["page_id"]]),
+                "result": result,
+            }
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def clear_ai_checkpoint(owner=None):
+    """
+    Remove this worker's checkpoint, and those of crashed workers left untouched
+    for AI_CHECKPOINT_STALE_SECONDS. Other running workers' checkpoints are kept.
+    """
+    own_path = ai_checkpoint_path(owner)
+    for path in _ai_checkpoint_files():
+        try:
+            if path == own_path or time.time() - os.path.getmtime(path) > AI_CHECKPOINT_STALE_SECONDS:
+                os.remove(path)
+        except OSError:
+            pass  # already removed by another worker
+
+
+def split_checkpointed(page_ids, page_texts, checkpoint):
+    """
+    Separate pages whose result is already checkpointed (for the same text) from those still to send.
+    Returns (checkpointed results, remaining_ids, remaining_texts).
+    """
+    done, remaining_ids, remaining_texts = [], [], []
+    for page_id, text in zip(page_ids, page_texts):
+        entry = checkpoint.get(page_id)
+        if entry and entry[0] == text_fingerprint(text):
+            done.append(entry[1])
+        else:
+            remaining_ids.append(page_id)
+            remaining_texts.append(text)
+    return done, remaining_ids, remaining_texts
@@ -1,21 +1,43 @@
-from dotenv import load_dotenv
 import os
 
 
-load_dotenv()  # this loads variables from .env into os.environ
+# Settings are resolved lazily (module __getattr__), so importing config does not touch .env.
+# Read them as `config.NOTION_TOKEN` at call time rather than `from config import NOTION_TOKEN`.
+_ENV_SETTINGS = {
+    ## notion_api
+    "NOTION_TOKEN",  # NOTION_TOKEN = "ntn_**********************************************"
+    "NOTION_DATABASE_ID",  #DATABASE_ID = "********************************"
+    "NOTION_WEBHOOK_SECRET",  # NOTION_WEBHOOK_SECRET = "secret_****" (verification_token of the webhook subscription)
 
-## notion_api
-NOTION_TOKEN = os.getenv("NOTION_TOKEN")  # NOTION_TOKEN = "ntn_**********************************************"
-NOTION_DATABASE_ID = os.getenv("NOTION_DATABASE_ID")  #DATABASE_ID = "********************************"
+    ## sheets_api: where you put google api json file
+    "GOOGLE_API_CRED",  # GOOGLE_API_CRED = "./google-api-cred/********************************.json"
 
-## sheets_api: where you put google api json file
-GOOGLE_API_CRED = os.getenv("GOOGLE_API_CRED")  # GOOGLE_API_CRED = "./google-api-cred/********************************.json"
+    ## deepseek_api
+    "DEEPSEEK_API",  # DEEPSEEK_API = "sk-********************************"
 
-## deepseek_api
-DEEPSEEK_API = os.getenv("DEEPSEEK_API")  # DEEPSEEK_API = "sk-********************************"
+    ## dispatcher.api
+    "CHROME_USER_DATA_DIR",  # CHROME_USER_DATA_DIR = "C:/Users/****/AppData/Local/Google/Chrome/User Data"
+    "CHROME_PROFILE",  # CHROME_PROFILE = "Default"
+    "CHROME_CANARY_LOCATION",  # CHROME_CANARY_LOCATION = "C:/Users/****/AppData/Local/Google/Chrome SxS/Application/chrome.exe"
+    "FIREFOX_USER_DATA",  # FIREFOX_USER_DATA = os.getenv("C:/Users/****/AppData/Roaming/Mozilla/Firefox/Profiles/****")
+}
 
-## dispatcher.api
-CHROME_USER_DATA_DIR = os.getenv("CHROME_USER_DATA_DIR")  # CHROME_USER_DATA_DIR = "C:/Users/****/AppData/Local/Google/Chrome/User Data"
-CHROME_PROFILE = os.getenv("CHROME_PROFILE")  # CHROME_PROFILE = "Default"
-CHROME_CANARY_LOCATION = os.getenv("CHROME_CANARY_LOCATION")  # CHROME_CANARY_LOCATION = "C:/Users/****/AppData/Local/Google/Chrome SxS/Application/chrome.exe"
-FIREFOX_USER_DATA = os.getenv("FIREFOX_USER_DATA")  # FIREFOX_USER_DATA = os.getenv("C:/Users/****/AppData/Roaming/Mozilla/Firefox/Profiles/****")
\ No newline at end of file
+_dotenv_loaded = False
+
+
+def load_env():
+    """
+    Load variables from .env into os.environ, once per process.
+    """
+    global _dotenv_loaded
+    if not _dotenv_loaded:
+        from dotenv import load_dotenv
+        load_dotenv()
+        _dotenv_loaded = True
+
+
+def __getattr__(name):
+    if name in _ENV_SETTINGS:
+        load_env()
+        return os.getenv(name)
+    raise AttributeError(f"module 'config' has no attribute '{name}'")
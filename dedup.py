@@ -0,0 +1,177 @@
+import json
+import os
+import random
+import re
+import time
+import zlib
+from utils import local_state_path, local_state_lock
+
+# MinHash / LSH settings. 16 bands x 4 rows puts the LSH candidate threshold around
+# Jaccard 0.5; candidates are then confirmed against DEDUP_SIMILARITY_THRESHOLD.
+DEDUP_SHINGLE_SIZE = 3           # character shingles, so it works for any language
+DEDUP_NUM_PERM = 64
+DEDUP_BANDS = 16
+DEDUP_SIMILARITY_THRESHOLD = 0.8
+DEDUP_HISTORY_LIMIT = 2000       # How many classified notes to keep in the persistent index
+DEDUP_INDEX_FILE = "dedup_index.json"
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+_rng = random.Random(1)  # fixed seed: signatures must stay comparable across runs
+_PERMUTATIONS = [(_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME))
+                 for _ in range(DEDUP_NUM_PERM)]
+
+
+def normalize_text(text):
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+def minhash_signature(text):
+    """
+    MinHash signature (DEDUP_NUM_PERM ints) of the character shingles of text.
+    """
+    norm = normalize_text(text)
+    k = DEDUP_SHINGLE_SIZE
+    shingles = {norm[i:i + k] for i in range(max(len(norm) - k + 1, 1))}
+    hashes = [zlib.crc32(s.encode("utf-8")) for s in shingles]
+    return [min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashes)
+            for a, b in _PERMUTATIONS]
+
+
+def estimate_similarity(sig_a, sig_b):
+    """
+    Estimated Jaccard similarity of two MinHash signatures.
+    """
+    return sum(x == y for x, y in zip(sig_a, sig_b)) / len(sig_a)
+
+
+def _band_keys(signature):
+    rows = DEDUP_NUM_PERM // DEDUP_BANDS
+    return [(band, tuple(signature[band * rows:(band + 1) * rows])) for band in range(DEDUP_BANDS)]
+
+
+def load_dedup_index():
+    """
+    Load the persistent near-duplicate index:
+      {page_id: {"text": <normalized text>, "sig": [...], "result": <AI result dict>, "ts": <unix time>}}
+    """
+    path = local_state_path(DEDUP_INDEX_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_dedup_index(index):
+    """
+    Merge index into the index on disk (under a lock, as several workers may save
+    concurrently); for a page in both, the more recently classified entry wins.
+    """
+    path = local_state_path(DEDUP_INDEX_FILE)
+    with local_state_lock(DEDUP_INDEX_FILE):
+        merged = load_dedup_index()
+        for page_id, entry in index.items():
+            if entry.get("ts", 0) >= merged.get(page_id, {}).get("ts", 0):
+                merged[page_id] = entry
+
+        # Keep only the most recently classified notes
+        entries = sorted(merged.items(), key=lambda item: item[1].get("ts", 0))[-DEDUP_HISTORY_LIMIT:]
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(dict(entries), f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+
+def copy_result(result, page_id, exact):
+    """
+    Copy an AI result onto another page. A lexical suggestion is a corrected
+    version of one specific text, so it is only kept for exact duplicates.
+    Copies are marked "source": "duplicate", as DeepSeek never saw that page.
+    """
+    copied = dict(result, page_id=page_id, source="duplicate")
+    if not exact:
+        copied["has_lexical_suggestion"] = False
+        copied["lexical_suggestion"] = ""
+    return copied
+
+
+def cluster_near_duplicates(page_ids, page_texts, index):
+    """
+    Group pending notes into near-duplicate clusters, checked against each other
+    and against the classified history in index.
+
+    Returns:
+      - rep_ids, rep_texts: one representative per new cluster, to send to the AI
+      - duplicates: {rep_id: [(page_id, exact), ...]} other members of that cluster
+      - reused_results: AI results copied from history for notes matching a classified note
+    """
+    buckets = {}
+    for hist_id, entry in index.items():
+        for key in _band_keys(entry["sig"]):
+            buckets.setdefault(key, []).append(hist_id)
+
+    rep_ids, rep_texts = [], []
+    duplicates = {}
+    reused_results = []
+    pending = {}  # rep_id -> (normalized text, signature)
+
+    for page_id, text in zip(page_ids, page_texts):
+        norm = normalize_text(text)
+        sig = minhash_signature(text)
+        best_id, best_sim = None, 0.0
+        for key in _band_keys(sig):
+            for cand_id in buckets.get(key, []):
+                if cand_id == page_id:
+                    continue  # the note's own, outdated history entry
+                cand_sig = index[cand_id]["sig"] if cand_id in index else pending[cand_id][1]
+                sim = estimate_similarity(sig, cand_sig)
+                if sim > best_sim:
+                    best_id, best_sim = cand_id, sim
+
+        if best_id is not None and best_sim >= DEDUP_SIMILARITY_THRESHOLD:
+            if best_id in pending:
+                duplicates[best_id].append((page_id, norm == pending[best_id][0]))
+                continue
+            entry = index[best_id]
+            reused_results.append(copy_result(entry["result"], page_id, norm == entry["text"]))
+            continue
+
+        # New cluster
+        rep_ids.append(page_id)
+        rep_texts.append(text)
+        duplicates[page_id] = []
+        pending[page_id] = (norm, sig)
+        for key in _band_keys(sig):
+            buckets.setdefault(key, []).append(page_id)
+
+    return rep_ids, rep_texts, duplicates, reused_results
+
+
+def expand_duplicate_results(results, duplicates):
+    """
+    Copy each representative's AI result to the other members of its cluster.
+    """
+    expanded = list(results)
+    for result in results:
+        if not isinstance(result, dict):
+            continue
+        for page_id, exact in duplicates.get(result.get("page_id", ""), []):
+            expanded.append(copy_result(result, page_id, exact))
+    return expanded
+
+
+def remember_classified(index, page_ids, page_texts, results):
+    """
+    Add freshly classified notes to the index so later runs can match against them.
+    """
+    texts = dict(zip(page_ids, page_texts))
+    for result in results:
+        if not isinstance(result, dict) or result.get("page_id") not in texts:
+            continue
+        page_id = result["page_id"]
+        index.pop(page_id, None)  # re-insert at the end: most recent last
+        index[page_id] = {
+            "text": normalize_text(texts[page_id]),
+            "sig": minhash_signature(texts[page_id]),
+            "result": result,
+            "ts": time.time(),
+        }
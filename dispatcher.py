@@ -1,32 +1,39 @@
 import time
-import pyperclip
-from selenium import webdriver
-from selenium.webdriver.firefox.options import Options
-from selenium.webdriver.common.by import By
-from selenium.webdriver.common.keys import Keys
-from config import FIREFOX_USER_DATA
+from typing import TYPE_CHECKING
+import config
+
+# Selenium and pyperclip are only imported once a dispatch actually runs
+if TYPE_CHECKING:
+    from selenium import webdriver
 
 # Use firefox for selenium
-def init_browser(headless: bool = False) -> webdriver.Firefox:
+def init_browser(headless: bool = False) -> "webdriver.Firefox":
     """
     Launches Firefox using an existing profile so you stay logged in to Milanote.
     - headless: if True, runs Firefox in headless mode
     """
+    from selenium import webdriver
+    from selenium.webdriver.firefox.options import Options
+
     options = Options()
     # Use the specified Firefox profile:
     options.add_argument('-profile')
-    options.add_argument(FIREFOX_USER_DATA)
+    options.add_argument(config.FIREFOX_USER_DATA)
     if headless:
         options.headless = True
     driver = webdriver.Firefox(options=options)
     driver.implicitly_wait(10)
     return driver
 
-def dispatch_note(driver: webdriver.Firefox, content: str, link: str) -> bool:
+def dispatch_note(driver: "webdriver.Firefox", content: str, link: str) -> bool:
     """
     Open the Milanote URL in a new tab, paste the text as an unsorted note, then close that tab.
     Returns True on success, False on any exception.
     """
+    import pyperclip
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.common.keys import Keys
+
     if not link:
         return True  # Empty link is treated as "dispatching to nowhere"
     flag = False
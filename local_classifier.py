@@ -0,0 +1,178 @@
+import math
+import random
+import re
+from collections import Counter
+
+# Notes whose top category probability reaches the threshold are labelled locally;
+# the rest still go to DeepSeek. Per-category overrides, e.g. {"Other": 0.98}.
+LOCAL_CLASSIFIER_CONFIDENCE_THRESHOLD = 0.9
+LOCAL_CLASSIFIER_CATEGORY_THRESHOLDS = {}
+LOCAL_CLASSIFIER_MIN_EXAMPLES = 50          # Don't train on less history than this
+LOCAL_CLASSIFIER_MIN_HOLDOUT_ACCURACY = 0.95  # Accuracy of confident holdout predictions needed to enable
+LOCAL_CLASSIFIER_HOLDOUT_FRACTION = 0.2
+LOCAL_CLASSIFIER_SMOOTHING = 0.5
+
+
+def extract_features(text):
+    """
+    Lower-cased word tokens plus character bigrams / trigrams,
+    so the features also work for text without spaces between words.
+    """
+    norm = re.sub(r"\s+", " ", text).strip().lower()
+    features = re.findall(r"\w+", norm)
+    for n in (2, 3):
+        features.extend(norm[i:i + n] for i in range(len(norm) - n + 1))
+    return Counter(features)
+
+
+def train_naive_bayes(texts, labels, alpha=LOCAL_CLASSIFIER_SMOOTHING):
+    """
+    Train a multinomial naive Bayes model.
+
+    Returns a dict:
+      {
+        "log_prior": {label: float},
+        "log_likelihood": {label: {feature: float}},
+        "log_unseen": {label: float}   # log-probability of a feature never seen with that label
+      }
+    """
+    feature_counts = {}
+    label_counts = Counter(labels)
+    vocabulary = set()
+    for text, label in zip(texts, labels):
+        counts = feature_counts.setdefault(label, Counter())
+        counts.update(extract_features(text))
+    for counts in feature_counts.values():
+        vocabulary.update(counts)
+
+    model = {"log_prior": {}, "log_likelihood": {}, "log_unseen": {}}
+    n_vocab = len(vocabulary) + 1
+    for label, counts in feature_counts.items():
+        denominator = sum(counts.values()) + alpha * n_vocab
+        model["log_prior"][label] = math.log(label_counts[label] / len(labels))
+        model["log_likelihood"][label] = {f: math.log((c + alpha) / denominator) for f, c in counts.items()}
+        model["log_unseen"][label] = math.log(alpha / denominator)
+    return model
+
+
+def predict_proba(model, text):
+    """
+    Return {label: probability} for text, sorted by descending probability.
+    """
+    features = extract_features(text)
+    scores = {}
+    for label, log_prior in model["log_prior"].items():
+        likelihood = model["log_likelihood"][label]
+        unseen = model["log_unseen"][label]
+        scores[label] = log_prior + sum(n * likelihood.get(f, unseen) for f, n in features.items())
+
+    # softmax in log-space
+    top = max(scores.values())
+    exp_scores = {label: math.exp(s - top) for label, s in scores.items()}
+    total = sum(exp_scores.values())
+    return dict(sorted(((label, v / total) for label, v in exp_scores.items()),
+                       key=lambda item: item[1], reverse=True))
+
+
+def confidence_threshold(label, threshold=LOCAL_CLASSIFIER_CONFIDENCE_THRESHOLD):
+    return LOCAL_CLASSIFIER_CATEGORY_THRESHOLDS.get(label, threshold)
+
+
+def evaluate_holdout(texts, labels, threshold=LOCAL_CLASSIFIER_CONFIDENCE_THRESHOLD,
+                     holdout_fraction=LOCAL_CLASSIFIER_HOLDOUT_FRACTION, seed=0):
+    """
+    Train on part of the history and score the rest.
+
+    Returns a dict with:
+      - "accuracy": accuracy over the whole holdout set
+      - "coverage": share of holdout notes confident enough to be labelled locally
+      - "confident_accuracy": accuracy over those confident notes (None if there are none)
+      - "holdout_size"
+    """
+    order = list(range(len(texts)))
+    random.Random(seed).shuffle(order)
+    n_holdout = max(1, int(len(order) * holdout_fraction))
+    holdout, train = order[:n_holdout], order[n_holdout:]
+
+    model = train_naive_bayes([texts[i] for i in train], [labels[i] for i in train])
+    correct = confident = confident_correct = 0
+    for i in holdout:
+        label, prob = next(iter(predict_proba(model, texts[i]).items()))
+        hit = label == labels[i]
+        correct += hit
+        if prob >= confidence_threshold(label, threshold):
+            confident += 1
+            confident_correct += hit
+
+    return {
+        "accuracy": correct / n_holdout,
+        "coverage": confident / n_holdout,
+        "confident_accuracy": confident_correct / confident if confident else None,
+        "holdout_size": n_holdout,
+    }
+
+
+def build_local_classifier(texts, categories, tags, threshold=LOCAL_CLASSIFIER_CONFIDENCE_THRESHOLD):
+    """
+    Train the local classifier from the sheet's DeepSeek-labelled history
+    (see sheets_api.fetch_labelled_examples) and report holdout accuracy.
+
+    Returns the classifier (a dict with the model and each category's known tags),
+    or None if there's too little history or confident holdout accuracy is too low.
+    """
+    if len(texts) < LOCAL_CLASSIFIER_MIN_EXAMPLES:
+        print(f"Local classifier: only {len(texts)} labelled notes, need {LOCAL_CLASSIFIER_MIN_EXAMPLES}. Disabled.")
+        return None
+
+    report = evaluate_holdout(texts, categories, threshold)
+    confident_accuracy = report["confident_accuracy"]
+    print(f"Local classifier holdout ({report['holdout_size']} notes): "
+          f"accuracy {report['accuracy']:.1%}, coverage {report['coverage']:.1%} at threshold {threshold}, "
+          f"confident accuracy {'n/a' if confident_accuracy is None else f'{confident_accuracy:.1%}'}")
+    if confident_accuracy is None or confident_accuracy < LOCAL_CLASSIFIER_MIN_HOLDOUT_ACCURACY:
+        print(f"Local classifier: confident accuracy below {LOCAL_CLASSIFIER_MIN_HOLDOUT_ACCURACY:.0%}. Disabled.")
+        return None
+
+    category_tags = {}
+    for category, tag_list in zip(categories, tags):
+        category_tags.setdefault(category, Counter()).update(t.lower() for t in tag_list)
+
+    return {
+        "model": train_naive_bayes(texts, categories),
+        "category_tags": category_tags,
+        "threshold": threshold,
+    }
+
+
+def classify_locally(classifier, page_ids, page_texts, allowed_labels=None):
+    """
+    Label the notes the local classifier is confident about.
+
+    Tags are the category's known tags that literally occur in the note.
+    The local classifier can't propose lexical suggestions, so those are left empty.
+    Results are marked "source": "local" so they are never used as training data.
+
+    Returns:
+      - local_results: result dicts in the same shape as the AI's
+      - remaining_ids, remaining_texts: notes that still need the AI
+    """
+    local_results, remaining_ids, remaining_texts = [], [], []
+    for page_id, text in zip(page_ids, page_texts):
+        label, prob = next(iter(predict_proba(classifier["model"], text).items()))
+        allowed = allowed_labels is None or label in allowed_labels
+        if not allowed or prob < confidence_threshold(label, classifier["threshold"]):
+            remaining_ids.append(page_id)
+            remaining_texts.append(text)
+            continue
+
+        lowered = text.lower()
+        tags = [t for t, _ in classifier["category_tags"].get(label, Counter()).most_common() if t in lowered]
+        local_results.append({
+            "page_id": page_id,
+            "category": label,
+            "tags": tags[:5],
+            "has_lexical_suggestion": False,
+            "lexical_suggestion": "",
+            "source": "local",
+        })
+    return local_results, remaining_ids, remaining_texts
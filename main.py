@@ -1,61 +1,183 @@
+import time
 from notion_api import *
 from sheets_api import *
 from ai_analysis import *
 from dispatcher import *
 from utils import *
+from dedup import *
+from local_classifier import *
+from webhook_receiver import *
 
 # Flag: new & to_analyse
-def notion_to_google_sheets():
-    all_pages = query_notion_database()
+# crawl_workers: crawl created_time ranges of the database concurrently; 1 for plain cursor pagination
+def notion_to_google_sheets(crawl_workers=NOTION_CRAWL_WORKERS):
+    start_sheet_snapshot_session()
+    if crawl_workers > 1:
+        all_pages = query_notion_database_parallel(crawl_workers)
+    else:
+        all_pages = query_notion_database()
     sheet_record = retrieve_notion_worksheet(NOTION_DISPATCHER_WORKSHEET_NAME_RECORD)
     bulk_import_notion_page(all_pages, sheet_record)  # Warning: potentially many API calls
 
+# Flag: new & to_analyse, pushed by Notion webhooks instead of polling (blocks; reconciles every WEBHOOK_RECONCILE_SECONDS)
+def notion_webhook_to_google_sheets(port=WEBHOOK_PORT):
+    run_webhook_receiver(port)
+
 # Flag: to_analyse -> ready_to_dispatch
-def google_sheets_to_ai():
+# local_confidence_threshold: notes the local classifier is at least this sure about skip DeepSeek; None disables it
+# Safe to run in several processes / hosts at once when the Record sheet has lease_owner / lease_expires columns
+def google_sheets_to_ai(local_confidence_threshold=LOCAL_CLASSIFIER_CONFIDENCE_THRESHOLD):
+    start_sheet_snapshot_session()
     sheet_category = retrieve_notion_worksheet(NOTION_DISPATCHER_WORKSHEET_NAME_CATEGORY)
     sheet_record = retrieve_notion_worksheet(NOTION_DISPATCHER_WORKSHEET_NAME_RECORD)
     categories = fetch_ai_categories(sheet_category)
-    page_ids, page_texts = fetch_page_texts_to_analyse(sheet_record)
+    lease_owner = new_lease_owner_id()
+    classifier = None
+    attempted = set()
+
+    while True:
+        pending_rows = [row for row in get_rows_to_analyse(sheet_record) if row.row not in attempted]
+        leased_rows = claim_rows(sheet_record, pending_rows, lease_owner, ANALYSE_STATUS_COLUMNS, is_pending_analysis)
+        if not leased_rows:
+            break
+        attempted.update(row.row for row in leased_rows)
+
+        # label high-confidence notes with the local classifier trained on past AI results (trained once per run)
+        if classifier is None and local_confidence_threshold is not None:
+            classifier = build_local_classifier(*fetch_labelled_examples(sheet_record), threshold=local_confidence_threshold) or False
+
+        try:
+            analyse_notes(sheet_record, [row.id.strip() for row in leased_rows], [row.content.strip() for row in leased_rows],
+                          categories, classifier, renew=lambda: renew_leases(sheet_record, leased_rows, lease_owner),
+                          checkpoint_owner=lease_owner)
+        finally:
+            release_leases(sheet_record, leased_rows, lease_owner)
+
+        if not lease_columns(sheet_record):
+            break  # no leasing: the single pass above covered every pending row
+
+    clear_ai_checkpoint(lease_owner)
+
+# Classify one set of notes: near-duplicates → checkpoint → local classifier → DeepSeek batches, written back per batch
+def analyse_notes(sheet_record, page_ids, page_texts, categories, classifier=None, renew=None, checkpoint_owner=None):
+    # only one note per near-duplicate cluster goes to the AI; history matches are reused outright
+    dedup_index = load_dedup_index()
+    rep_ids, rep_texts, duplicates, reused_results = cluster_near_duplicates(page_ids, page_texts, dedup_index)
+    print(f"{len(page_ids)} notes to analyse: {len(rep_ids)} unique, "
+          f"{len(page_ids) - len(rep_ids) - len(reused_results)} copied from duplicates, "
+          f"{len(reused_results)} reused from history.")
+
+    # results a crashed run already paid for are written back instead of being sent again
+    checkpointed_results, ai_ids, ai_texts = split_checkpointed(rep_ids, rep_texts, load_ai_checkpoint())
+    if checkpointed_results:
+        print(f"Resuming: {len(checkpointed_results)} results recovered from the checkpoint.")
+
+    local_results = []
+    if classifier and ai_ids:
+        allowed_labels = {cat["label"] for cat in categories} | {"Other"}
+        local_results, ai_ids, ai_texts = classify_locally(classifier, ai_ids, ai_texts, allowed_labels)
+        print(f"Local classifier labelled {len(local_results)} notes, {len(ai_ids)} sent to AI.")
+
+    # write everything that needs no AI call first
+    ready_results = expand_duplicate_results(checkpointed_results + local_results, duplicates) + reused_results
+    if ready_results:
+        update_ai_classification_in_record(sheet_record, ready_results)
 
     # decide on a conservative character budget for the user_content segment
     # note: you also have system_content (~200–300 chars) and category list (~n*X chars)
     max_chars_per_batch = PROMPT_LENGTH_LIMIT - PROMPT_FIXED_OVERHEAD  # leave headroom for system + categories
 
-    all_results = []
-    batches = chunk_page_items(page_ids, page_texts, max_chars_per_batch)
-    for batch_ids, batch_texts in batches:
-        prompt = build_batch_prompt(batch_ids, batch_texts, categories)
+    # with many categories, route notes to a category group first so each prompt only lists that group
+    groups = group_categories(categories) if ai_ids else None
+    if groups:
+        routed = route_notes(ai_ids, ai_texts, groups, max_chars_per_batch)
+        print(f"Routed {len(ai_ids)} notes to {len(routed)} of {len(groups)} category groups.")
+        batches = [(batch_ids, batch_texts, groups[group])
+                   for group, (group_ids, group_texts) in routed.items()
+                   for batch_ids, batch_texts in chunk_page_items(group_ids, group_texts, max_chars_per_batch)]
+    else:
+        batches = [(batch_ids, batch_texts, categories)
+                   for batch_ids, batch_texts in chunk_page_items(ai_ids, ai_texts, max_chars_per_batch)]
+
+    for batch_no, (batch_ids, batch_texts, batch_categories) in enumerate(batches, start=1):
+        print(f"→ AI batch {batch_no}/{len(batches)} ({len(batch_ids)} notes) …")
+        prompt = build_batch_prompt(batch_ids, batch_texts, batch_categories)
         try:
             batch_results = send_to_deepseek_ai(prompt)
         except ValueError as e:
             # you might choose to log/raise if a *single* text is itself too large
             raise RuntimeError(f"Single text too large: {e}") from e
+        batch_results = decode_batch_results(batch_ids, batch_results, batch_categories)
 
-        all_results.extend(batch_results)
+        # checkpoint before touching the sheet, so at most this batch is lost on a crash
+        append_ai_checkpoint(batch_ids, batch_texts, batch_results, checkpoint_owner)
+        remember_classified(dedup_index, batch_ids, batch_texts, batch_results)
+        save_dedup_index(dedup_index)
 
-    # now write all at once (or incrementally) back to Sheets
-    update_ai_classification_in_record(sheet_record, all_results)
+        # write this batch (and its near-duplicates) back incrementally
+        update_ai_classification_in_record(sheet_record, expand_duplicate_results(batch_results, duplicates))
+        if renew:
+            renew()
 
 # Flag: ready_to_dispatch -> dispatched
+# Safe to run in several processes / hosts at once when the Record sheet has lease_owner / lease_expires columns
 def google_sheets_to_dispatch():
+    start_sheet_snapshot_session()
     sheet_record = retrieve_notion_worksheet(NOTION_DISPATCHER_WORKSHEET_NAME_RECORD)
-    rows = get_rows_to_dispatch(sheet_record)
-    print(f"Found {len(rows)} rows to dispatch.")
-    driver = init_browser()
-    for row_idx, content, link in rows:
-        print(f"→ Dispatching row {row_idx} …")
-        if dispatch_note(driver, content, link):
-            mark_dispatched(sheet_record, row_idx)
+    lease_owner = new_lease_owner_id()
+    attempted = set()
+    driver = None
+
+    while True:
+        pending_rows = [row for row in get_rows_to_dispatch(sheet_record) if row.row not in attempted]
+        rows = claim_rows(sheet_record, pending_rows, lease_owner, DISPATCH_STATUS_COLUMNS, is_pending_dispatch)
+        print(f"Found {len(pending_rows)} rows to dispatch, claimed {len(rows)}.")
+        if not rows:
+            break
+        attempted.update(row.row for row in rows)
+        if driver is None:
+            driver = init_browser()
+
+        try:
+            last_renewed = time.monotonic()
+            with own_snapshot_write(sheet_record):  # one revision check for the whole batch
+                for row in rows:
+                    # another worker may have taken the row over (e.g. our lease expired): never post twice
+                    if not held_leases(sheet_record, [row], lease_owner):
+                        print(f"→ Row {row.row} is no longer leased by this worker, skipped.")
+                        continue
+                    print(f"→ Dispatching row {row.row} …")
+                    if dispatch_note(driver, row.content_to_dispatch, row.link):
+                        mark_dispatched(sheet_record, row.row)
+                    if time.monotonic() - last_renewed > LEASE_DURATION_SECONDS / 2:
+                        renew_leases(sheet_record, rows, lease_owner)
+                        last_renewed = time.monotonic()
+        finally:
+            release_leases(sheet_record, rows, lease_owner)
+
+        if not lease_columns(sheet_record):
+            break  # no leasing: the single pass above covered every pending row
+
     print("Dispatch complete.")
-    driver.quit()
+    if driver is not None:
+        driver.quit()
 
 # Flag: dispatched -> source_archived
 def google_sheets_to_archive():
+    start_sheet_snapshot_session()
     sheet = retrieve_notion_worksheet(NOTION_DISPATCHER_WORKSHEET_NAME_RECORD)
     rows = get_rows_to_archive(sheet)
     print(f"Found {len(rows)} rows to archive in Notion.")
-    for row_idx, record_id in rows:
-        print(f"→ Archiving Notion record {record_id} (row {row_idx}) …")
-        if remove_notion_record(record_id):
-            mark_source_archived(sheet, row_idx)
+    with own_snapshot_write(sheet):  # one revision check for the whole pass
+        for row in rows:
+            print(f"→ Archiving Notion record {row.id} (row {row.row}) …")
+            if remove_notion_record(row.id):
+                mark_source_archived(sheet, row.row)
     print("Archive pass complete.\n")
+
+# Flag: source_archived -> moved to the dated archive worksheet
+def google_sheets_compact():
+    start_sheet_snapshot_session()
+    sheet = retrieve_notion_worksheet(NOTION_DISPATCHER_WORKSHEET_NAME_RECORD)
+    moved = compact_record_sheet(sheet)
+    print(f"Compaction complete: moved {moved} finished rows out of the Record sheet.\n")
@@ -1,21 +1,40 @@
-import requests
-from config import NOTION_TOKEN, NOTION_DATABASE_ID
-from notion_client import Client
-from notion_client.errors import APIResponseError
+import queue
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+import config
 
-notion = Client(auth=NOTION_TOKEN)
+_notion_client = None
+_rate_limiter = None
 
-def query_notion_database():
+NOTION_API_VERSION = "2022-06-28"
+NOTION_REQUESTS_PER_SECOND = 3     # Notion's documented average rate limit per integration
+NOTION_CRAWL_WORKERS = 4
+NOTION_REQUEST_TIMEOUT = 30        # seconds, so a poor network fails instead of hanging
+NOTION_MAX_RETRIES = 5
+
+
+def get_notion_client():
+    """
+    Return the shared Notion SDK client, building it on first use.
+    """
+    global _notion_client
+    if _notion_client is None:
+        from notion_client import Client
+        _notion_client = Client(auth=config.NOTION_TOKEN)
+    return _notion_client
+
+
+def query_notion_database(filter=None):
     """
     Fetch all pages in the specified Notion database,
     handling pagination if there are more than 100 results.
+    An optional Notion query filter limits the pages returned.
     """
-    url = f"https://api.notion.com/v1/databases/{NOTION_DATABASE_ID}/query"
-    headers = {
-        "Authorization": f"Bearer {NOTION_TOKEN}",
-        "Notion-Version": "2022-06-28",
-        "Content-Type": "application/json"
-    }
+    import requests
+
+    url = notion_database_query_url()
+    headers = notion_headers()
 
     all_pages = []
     has_more = True
@@ -23,7 +42,9 @@ def query_notion_database():
 
     while has_more:
         payload = {}
-        
+        if filter:
+            payload["filter"] = filter
+
         # If we've already retrieved some pages, use next_cursor to get the next batch
         if next_cursor:
             payload["start_cursor"] = next_cursor
@@ -42,6 +63,184 @@ def query_notion_database():
     return all_pages
 
 
+def notion_database_query_url():
+    return f"https://api.notion.com/v1/databases/{config.NOTION_DATABASE_ID}/query"
+
+
+def notion_headers():
+    return {
+        "Authorization": f"Bearer {config.NOTION_TOKEN}",
+        "Notion-Version": NOTION_API_VERSION,
+        "Content-Type": "application/json"
+    }
+
+
+class RateLimiter:
+    """
+    Spaces out calls shared by several threads to at most `rate` per second.
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        time.sleep(max(0.0, slot - now))
+
+
+def shared_rate_limiter():
+    """
+    The process-wide RateLimiter for Notion requests (crawls, reconciliation).
+    """
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = RateLimiter(NOTION_REQUESTS_PER_SECOND)
+    return _rate_limiter
+
+
+def post_notion_query(session, payload, rate_limiter):
+    """
+    POST one database query under the shared rate limiter, honouring 429 Retry-After.
+    """
+    for attempt in range(1, NOTION_MAX_RETRIES + 1):
+        rate_limiter.wait()
+        response = session.post(notion_database_query_url(), headers=notion_headers(),
+                                json=payload, timeout=NOTION_REQUEST_TIMEOUT)
+        if response.status_code == 429 or response.status_code >= 500:
+            if attempt == NOTION_MAX_RETRIES:
+                response.raise_for_status()
+            retry_after = float(response.headers.get("Retry-After", 2 ** attempt))
+            print(f"[NotionAPI] HTTP {response.status_code}, retrying in {retry_after}s (attempt {attempt}/{NOTION_MAX_RETRIES})")
+            time.sleep(retry_after)
+            continue
+        response.raise_for_status()
+        return response.json()
+
+
+def _created_time_filter(start, end):
+    return {"and": [
+        {"timestamp": "created_time", "created_time": {"on_or_after": start.isoformat()}},
+        {"timestamp": "created_time", "created_time": {"before": end.isoformat()}},
+    ]}
+
+
+def _parse_notion_time(value):
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def query_notion_database_parallel(workers=NOTION_CRAWL_WORKERS):
+    """
+    Fetch all pages in the Notion database like query_notion_database, but
+    crawl disjoint created_time ranges concurrently.
+
+    The span from the oldest page to now is cut into one range per worker.
+    The first page of results in each range (sorted by created_time) doubles as
+    a sample: if the range has more, the rest of it is split in two and both halves
+    are queued, so busy periods end up in many small ranges and quiet ones in few.
+    A range that can't be split further (Notion created_time has minute precision)
+    falls back to cursor pagination. All requests share one rate limiter.
+
+    Results are de-duplicated by page id and returned newest first.
+    """
+    import requests
+
+    rate_limiter = shared_rate_limiter()
+    session = requests.Session()
+
+    # Oldest page bounds the crawl
+    first = post_notion_query(session, {
+        "page_size": 1,
+        "sorts": [{"timestamp": "created_time", "direction": "ascending"}],
+    }, rate_limiter)
+    if not first["results"]:
+        return []
+    lower = _parse_notion_time(first["results"][0]["created_time"])
+    upper = datetime.now(timezone.utc) + timedelta(minutes=1)
+
+    tasks = queue.Queue()
+    step = (upper - lower) / workers
+    for i in range(workers):
+        start = lower + step * i
+        end = upper if i == workers - 1 else lower + step * (i + 1)
+        tasks.put((start, end, None))
+
+    pages_by_id = {}
+    errors = []
+    lock = threading.Lock()
+
+    def crawl_range(start, end, cursor):
+        payload = {
+            "page_size": 100,
+            "filter": _created_time_filter(start, end),
+            "sorts": [{"timestamp": "created_time", "direction": "ascending"}],
+        }
+        if cursor:
+            payload["start_cursor"] = cursor
+        data = post_notion_query(session, payload, rate_limiter)
+        with lock:
+            for page in data["results"]:
+                pages_by_id[page["id"]] = page
+        if not data.get("has_more"):
+            return
+
+        # Split what's left of the range when possible; pages at the boundary minute are fetched again and de-duplicated
+        last_seen = _parse_notion_time(data["results"][-1]["created_time"])
+        mid = last_seen + (end - last_seen) / 2
+        if cursor is None and last_seen > start and mid - last_seen >= timedelta(minutes=1):
+            tasks.put((last_seen, mid, None))
+            tasks.put((mid, end, None))
+        else:
+            tasks.put((start, end, data["next_cursor"]))
+
+    def worker():
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            try:
+                if not errors:
+                    crawl_range(*task)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                tasks.task_done()
+
+    for _ in range(workers):
+        threading.Thread(target=worker, daemon=True).start()
+    tasks.join()
+    for _ in range(workers):
+        tasks.put(None)
+    if errors:
+        raise errors[0]
+
+    return sorted(pages_by_id.values(), key=lambda page: page.get("created_time", ""), reverse=True)
+
+
+def retrieve_notion_pages(page_ids):
+    """
+    Fetch the given pages one by one, keeping only live pages of our database.
+    Pages that can't be retrieved (deleted, no access) are skipped with a message.
+    """
+    from notion_client.errors import APIResponseError
+
+    database_id = config.NOTION_DATABASE_ID.replace("-", "")
+    pages = []
+    for page_id in page_ids:
+        try:
+            page = get_notion_client().pages.retrieve(page_id=page_id)
+        except APIResponseError as e:
+            print(f"[NotionAPI] Failed to retrieve {page_id}: {e}")
+            continue
+        parent_id = page.get("parent", {}).get("database_id", "").replace("-", "")
+        if parent_id == database_id and not page.get("archived") and not page.get("in_trash"):
+            pages.append(page)
+    return pages
+
+
 def get_notion_page_text(page_obj):
     """
     Extract textual content from a Notion page object.
@@ -60,9 +259,11 @@ def remove_notion_record(record_id: str) -> bool:
     """
     Archives a Notion page by its ID.
     """
+    from notion_client.errors import APIResponseError
+
     try:
         # The pages.update endpoint supports an `archived` flag
-        notion.pages.update(page_id=record_id, archived=True)
+        get_notion_client().pages.update(page_id=record_id, archived=True)
         return True
     except APIResponseError as e:
         print(f"[NotionAPI] Failed to archive {record_id}: {e}")
@@ -1,40 +1,52 @@
-import time, sys
-from dateutil.tz import tzutc
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-from config import GOOGLE_API_CRED
-from dateutil import parser
-from gspread.utils import rowcol_to_a1
-from gspread.exceptions import APIError
+import json, os, socket, time, sys, uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, NamedTuple
+import config
+from utils import local_state_path
 
 NOTION_DISPATCHER_SPREADSHEET_NAME = "Notion Notes Nexus"
 NOTION_DISPATCHER_WORKSHEET_NAME_CATEGORY = "Category"
 NOTION_DISPATCHER_WORKSHEET_NAME_RECORD = "Record"
 
+# gspread / oauth2client are imported on first use; the spreadsheet handle is reused across stages
+_spreadsheet = None
+
 
 # -------
 # Generic
 # -------
 
 
-def retrieve_notion_worksheet(worksheet_name):
-    # Define the scope for accessing Google Sheets and Google Drive
-    scope = [
-        'https://spreadsheets.google.com/feeds',
-        'https://www.googleapis.com/auth/drive'
-    ]
+def get_notion_spreadsheet():
+    """
+    Return the shared handle of the dispatcher spreadsheet, authorizing on first use.
+    """
+    global _spreadsheet
+    if _spreadsheet is None:
+        import gspread
+        from oauth2client.service_account import ServiceAccountCredentials
 
-    # Provide the path to your credentials JSON file
-    creds = ServiceAccountCredentials.from_json_keyfile_name(GOOGLE_API_CRED, scope)
+        # Define the scope for accessing Google Sheets and Google Drive
+        scope = [
+            'https://spreadsheets.google.com/feeds',
+            'https://www.googleapis.com/auth/drive'
+        ]
 
-    # Authorize the client
-    client = gspread.authorize(creds)
+        # Provide the path to your credentials JSON file
+        creds = ServiceAccountCredentials.from_json_keyfile_name(config.GOOGLE_API_CRED, scope)
 
-    # Open the spreadsheet by its title (or you can use open_by_key or open_by_url)
-    spreadsheet = client.open(NOTION_DISPATCHER_SPREADSHEET_NAME)
+        # Authorize the client
+        client = gspread.authorize(creds)
 
+        # Open the spreadsheet by its title (or you can use open_by_key or open_by_url)
+        _spreadsheet = client.open(NOTION_DISPATCHER_SPREADSHEET_NAME)
+    return _spreadsheet
+
+
+def retrieve_notion_worksheet(worksheet_name):
     # Retrieve the worksheet by its title (or use worksheet(index) for the index)
-    worksheet = spreadsheet.worksheet(worksheet_name)
+    worksheet = get_notion_spreadsheet().worksheet(worksheet_name)
 
     # Now worksheet is a gspread Worksheet object that you can work with.
     return worksheet
@@ -80,6 +92,8 @@ def safe_gspread_call(func, *args, **kwargs):
     Raises:
       - The last exception if we exceed MAX_RETRIES.
     """
+    from gspread.exceptions import APIError
+
     attempt = 0
     while True:
         try:
@@ -98,6 +112,316 @@ def safe_gspread_call(func, *args, **kwargs):
             raise
 
 
+# --------------
+# Snapshot cache
+# --------------
+
+# Columns read from the spreadsheet are kept on disk together with the spreadsheet's
+# Drive modifiedTime. While modifiedTime is unchanged they are served locally; any
+# change by someone else drops the whole snapshot. modifiedTime is checked once per
+# stage (start_sheet_snapshot_session) and around each batch of our own writes
+# (own_snapshot_write). The revision after our writes is adopted only if the snapshot
+# was current before them and Drive's revision history since then shows only our
+# service account; otherwise the snapshot is dropped. With lease columns (several
+# workers sharing one service account) our writes can't be told apart, so the
+# snapshot is always dropped after writing.
+# Columns the sheet computes (formulas such as ready_to_dispatch, content_to_dispatch,
+# link) can change with any write, so they are dropped on each of our writes.
+# clear_sheet_snapshot() forces a full re-read.
+SHEET_SNAPSHOT_FILE = "sheet_snapshots.json"
+
+# Columns only ever changed by our own writes (or by hand, which changes the revision)
+SNAPSHOT_DIRECT_COLUMNS = {
+    "id", "created_time", "last_edited_time", "content", "to_analyse",
+    "ai_category", "ai_tags", "has_lexical_suggestion", "lexical_suggestion", "ai_source",
+    "dispatched", "source_archived",
+}
+
+_sheet_snapshot = None  # {"modified_time": str, "sheets": {title: {"headers": [...], "columns": {name: [...]}}}}
+_snapshot_verified = False  # modifiedTime already checked during this stage
+_own_write_depth = 0        # Nesting of own_snapshot_write blocks; only the outermost checks revisions
+
+
+def _load_sheet_snapshot():
+    global _sheet_snapshot
+    if _sheet_snapshot is None:
+        path = local_state_path(SHEET_SNAPSHOT_FILE)
+        _sheet_snapshot = {"modified_time": None, "sheets": {}}
+        if os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    _sheet_snapshot = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                pass  # a broken snapshot is just a cache miss
+    return _sheet_snapshot
+
+
+def _save_sheet_snapshot():
+    path = local_state_path(SHEET_SNAPSHOT_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(_sheet_snapshot, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+
+def _reset_sheet_snapshot(revision=None):
+    _sheet_snapshot["modified_time"] = revision
+    _sheet_snapshot["sheets"] = {}
+
+
+def clear_sheet_snapshot():
+    global _sheet_snapshot
+    _sheet_snapshot = {"modified_time": None, "sheets": {}}
+    _save_sheet_snapshot()
+
+
+def start_sheet_snapshot_session():
+    """
+    Call at the start of each stage: the next read checks modifiedTime again.
+    """
+    global _snapshot_verified
+    _snapshot_verified = False
+
+
+def get_spreadsheet_revision(worksheet):
+    """
+    The spreadsheet's Drive modifiedTime: one metadata call, no cell data.
+    """
+    return safe_gspread_call(worksheet.spreadsheet.get_lastUpdateTime)
+
+
+def fresh_sheet_snapshot(worksheet):
+    """
+    Return the snapshot entry {"headers", "columns"} of this worksheet,
+    emptied first if the spreadsheet changed since the snapshot was taken.
+    modifiedTime is checked once per stage, not on every read.
+    """
+    global _snapshot_verified
+    snapshot = _load_sheet_snapshot()
+    if not _snapshot_verified or snapshot["modified_time"] is None:
+        revision = get_spreadsheet_revision(worksheet)
+        if snapshot["modified_time"] != revision:
+            _reset_sheet_snapshot(revision)
+        _snapshot_verified = True
+    return snapshot["sheets"].setdefault(worksheet.title, {"headers": None, "columns": {}})
+
+
+def _snapshot_cell_text(value):
+    # What get_all_values / batch_get would read back for a value we wrote
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    return "" if value is None else str(value)
+
+
+def _only_own_revisions(worksheet, since, until) -> bool:
+    """
+    Whether every Drive revision of the spreadsheet after `since` (a modifiedTime) was made by
+    our service account, and the revision history already reaches `until` (it can lag behind).
+    """
+    from gspread.urls import DRIVE_FILES_API_V3_URL
+
+    http_client = worksheet.spreadsheet.client.http_client
+    email = getattr(http_client.auth, "service_account_email", None)
+    if not email:
+        return False
+    url = f"{DRIVE_FILES_API_V3_URL}/{worksheet.spreadsheet.id}/revisions"
+    params = {"pageSize": 1000, "fields": "nextPageToken,revisions(modifiedTime,lastModifyingUser(emailAddress))"}
+    newer = []
+    while True:
+        response = safe_gspread_call(http_client.request, "get", url, params=params).json()
+        newer.extend(r for r in response.get("revisions", []) if r.get("modifiedTime", "") > since)
+        if not response.get("nextPageToken"):
+            break
+        params["pageToken"] = response["nextPageToken"]
+    if not newer or max(r["modifiedTime"] for r in newer) < until:
+        return False
+    return all(r.get("lastModifyingUser", {}).get("emailAddress") == email for r in newer)
+
+
+@contextmanager
+def own_snapshot_write(worksheet):
+    """
+    Wrap each batch of our own writes (with their note_own_write calls):
+
+        with own_snapshot_write(worksheet):
+            for row in rows:
+                safe_gspread_call(worksheet.update_cell, row, col, "TRUE")
+                note_own_write(worksheet, row, col, ["TRUE"])
+
+    Before the batch, the snapshot is dropped if the spreadsheet changed since it was taken.
+    After it, computed columns are dropped, and the new modifiedTime is adopted only if
+    nobody else wrote in between (see _only_own_revisions); otherwise the snapshot is dropped.
+    Nested blocks join the outermost one.
+    """
+    global _own_write_depth
+    if _own_write_depth:
+        _own_write_depth += 1
+        try:
+            yield
+        finally:
+            _own_write_depth -= 1
+        return
+
+    snapshot = _load_sheet_snapshot()
+    before = snapshot["modified_time"]
+    in_sync = before is not None and get_spreadsheet_revision(worksheet) == before
+    if not in_sync:
+        _reset_sheet_snapshot()
+    shared = in_sync and "lease_owner" in get_sheet_headers(worksheet)
+    _own_write_depth = 1
+    try:
+        yield
+    finally:
+        _own_write_depth = 0
+        sheet = snapshot["sheets"].get(worksheet.title)
+        if sheet:
+            for name in [name for name in sheet["columns"] if name not in SNAPSHOT_DIRECT_COLUMNS]:
+                del sheet["columns"][name]
+        after = get_spreadsheet_revision(worksheet) if in_sync and not shared else None
+        if after is not None and (after == before or _only_own_revisions(worksheet, before, after)):
+            snapshot["modified_time"] = after
+        else:
+            _reset_sheet_snapshot()
+        _save_sheet_snapshot()
+
+
+def note_own_write(worksheet, row, first_col, values):
+    """
+    Patch the snapshot after we wrote `values` to `row` from column `first_col` on.
+    Call inside own_snapshot_write.
+    """
+    sheet = _load_sheet_snapshot()["sheets"].get(worksheet.title)
+    if not sheet or not sheet["headers"]:
+        return
+    headers = sheet["headers"]
+    for offset, value in enumerate(values):
+        col = first_col + offset
+        if col > len(headers) or headers[col - 1] not in sheet["columns"]:
+            continue
+        column = sheet["columns"][headers[col - 1]]
+        column.extend([""] * (row - 1 - len(column)))
+        column[row - 2] = _snapshot_cell_text(value)
+
+
+def drop_sheet_snapshot(worksheet):
+    """
+    Forget a worksheet's snapshot after a write too large to patch.
+    """
+    _load_sheet_snapshot()["sheets"].pop(worksheet.title, None)
+
+
+# ------------------
+# Column-range reads
+# ------------------
+
+
+class RecordRow(NamedTuple):
+    """
+    One row of the 'Record' sheet, holding only the columns a stage asked for.
+    Columns that were not fetched keep their defaults ("" / False).
+    """
+    row: int  # 1-based sheet row number
+    id: str = ""
+    content: str = ""
+    content_to_dispatch: str = ""
+    link: str = ""
+    ai_category: str = ""
+    ai_tags: str = ""
+    ai_source: str = ""
+    lease_owner: str = ""
+    lease_expires: str = ""
+    to_analyse: bool = False
+    ready_to_dispatch: bool = False
+    dispatched: bool = False
+    source_archived: bool = False
+
+
+RECORD_BOOL_COLUMNS = ("to_analyse", "ready_to_dispatch", "dispatched", "source_archived")
+
+
+def parse_sheet_bool(value) -> bool:
+    """
+    Interpret a checkbox cell ("TRUE"/"FALSE", "1"/"0", or blank) as a bool.
+    """
+    return str(value).strip().lower() in ('true', '1')
+
+
+def column_a1_letter(col: int) -> str:
+    """
+    1-based column index → A1 column letter(s), e.g. 3 → "C".
+    """
+    from gspread.utils import rowcol_to_a1
+    return rowcol_to_a1(1, col).rstrip("0123456789")
+
+
+def batch_get_columns(worksheet, column_names, headers=None, fresh=False) -> Dict[str, List[str]]:
+    """
+    Fetch only the named columns (below the header) with a single batch_get.
+    Columns already in an up-to-date snapshot are served locally and not fetched again;
+    fresh=True always fetches them and leaves the snapshot untouched (used for leasing,
+    where other workers' writes must be seen).
+
+    Returns a dict {column name: list of cell strings}, where every list
+    has the same length and index i is sheet row i + 2.
+    Raises if any of the columns is missing from the header row.
+    """
+    sheet = fresh_sheet_snapshot(worksheet)
+    if headers is None:
+        headers = get_sheet_headers(worksheet)
+    missing = [name for name in column_names if name not in headers]
+    if missing:
+        raise Exception(f"Required columns {missing} are not found in the sheet's first row.")
+
+    fetched = {}
+    to_fetch = [name for name in column_names if fresh or name not in sheet["columns"]]
+    if to_fetch:
+        ranges = []
+        for name in to_fetch:
+            letter = column_a1_letter(headers.index(name) + 1)
+            ranges.append(f"{letter}2:{letter}")
+
+        # major_dimension=COLUMNS gives one flat list per range; trailing blanks are omitted by the API
+        value_ranges = safe_gspread_call(worksheet.batch_get, ranges, major_dimension="COLUMNS")
+        for name, vr in zip(to_fetch, value_ranges):
+            fetched[name] = list(vr[0]) if vr else []
+        if not fresh:
+            sheet["columns"].update(fetched)
+            _save_sheet_snapshot()
+
+    columns = [fetched[name] if name in fetched else sheet["columns"][name] for name in column_names]
+    n_rows = max((len(c) for c in columns), default=0)
+    return {
+        name: list(values) + [""] * (n_rows - len(values))
+        for name, values in zip(column_names, columns)
+    }
+
+
+def get_sheet_headers(worksheet) -> List[str]:
+    """
+    The worksheet's header row, from the snapshot when it's up to date.
+    """
+    sheet = fresh_sheet_snapshot(worksheet)
+    if sheet["headers"] is None:
+        sheet["headers"] = safe_gspread_call(worksheet.row_values, 1)
+        _save_sheet_snapshot()
+    return sheet["headers"]
+
+
+def read_record_rows(worksheet, column_names, fresh=False) -> List[RecordRow]:
+    """
+    Read the given 'Record' columns and return them as RecordRow objects,
+    with checkbox columns parsed to bools. fresh=True bypasses the snapshot.
+    """
+    columns = batch_get_columns(worksheet, column_names, fresh=fresh)
+    n_rows = len(next(iter(columns.values()), []))
+    rows = []
+    for i in range(n_rows):
+        fields = {}
+        for name, values in columns.items():
+            fields[name] = parse_sheet_bool(values[i]) if name in RECORD_BOOL_COLUMNS else values[i]
+        rows.append(RecordRow(row=i + 2, **fields))
+    return rows
+
+
 # -----------------------------------------
 # Import Notion pages & Send to AI & Output
 # -----------------------------------------
@@ -111,51 +435,38 @@ def fetch_ai_categories(worksheet):
       - "Category"
       - "Descrption"
       - "AI Category?"
+    and optionally "Group" (parent group used for two-stage routing).
     Additional columns may exist, but won't be used here.
 
     Returns:
         A list of dicts, each with:
         {
             "label": <Category cell>,
-            "description": <Descrption cell>
+            "description": <Descrption cell>,
+            "group": <Group cell>           # only if the sheet has a "Group" column
         }
       Only includes rows where "AI Category?" == "TRUE".
     """
-    # 1) Read the header row (row 1) to find column indices
-    headers = worksheet.row_values(1)
-    try:
-        category_col_idx = headers.index("Category") + 1
-        description_col_idx = headers.index("Descrption") + 1
-        ai_col_idx = headers.index("AI Category?") + 1
-    except ValueError:
-        raise Exception("The required columns ('Category', 'Descrption', 'AI Category?') "
-                        "are not all found in the sheet's first row.")
-
-    # 2) Get all values in the sheet (or you can read row by row)
-    #    row_values(1) was the header. Let's get the entire sheet to parse each row.
-    all_data = worksheet.get_all_values()
-    
-    # 3) Build our output list
+    # 1) Fetch only the columns we need (below the header)
+    column_names = ["Category", "Descrption", "AI Category?"]
+    has_group = "Group" in get_sheet_headers(worksheet)
+    if has_group:
+        column_names.append("Group")
+    columns = batch_get_columns(worksheet, column_names)
+
+    # 2) Build our output list
     categories_list = []
-
-    # Skip row 0 (header row), iterate from row 2 onward
-    for row_idx in range(1, len(all_data)):
-        row = all_data[row_idx]
-        # Ensure row has enough columns (in case of short rows)
-        if len(row) < max(category_col_idx, description_col_idx, ai_col_idx):
-            continue
-
-        label_val = row[category_col_idx - 1].strip()
-        desc_val = row[description_col_idx - 1].strip()
-        ai_val = row[ai_col_idx - 1].strip().upper()  # e.g., "TRUE", "FALSE"
-        
+    for i, (label_val, desc_val, ai_val) in enumerate(zip(columns["Category"], columns["Descrption"], columns["AI Category?"])):
         # Only add if "AI Category?" is "TRUE"
-        if ai_val == "TRUE":
-            categories_list.append({
-                "label": label_val,
-                "description": desc_val
-            })
-    
+        if ai_val.strip().upper() == "TRUE":
+            category = {
+                "label": label_val.strip(),
+                "description": desc_val.strip()
+            }
+            if has_group:
+                category["group"] = columns["Group"][i].strip()
+            categories_list.append(category)
+
     return categories_list
 
 
@@ -165,6 +476,10 @@ def import_notion_page(page, worksheet):
     filling the first empty row if new, or updating the existing row if older.
     This version does minimal requests by updating the entire row at once.
     """
+    import gspread
+    from dateutil import parser
+    from dateutil.tz import tzutc
+    from gspread.utils import rowcol_to_a1
 
     # 1) Extract primary fields
     page_id = page.get("id", "")
@@ -212,16 +527,16 @@ def import_notion_page(page, worksheet):
     except gspread.exceptions.CellNotFound:
         cell = None
 
+    if cell is None and is_archived_page_id(page_id):
+        # Already dispatched, archived and compacted out of the sheet: don't re-import
+        return False
+
     if cell is None:
         # -----------------------------
         # NEW RECORD: find empty row
         # -----------------------------
         empty_id_row = find_first_empty_id_row(worksheet, id_col)
 
-        # If row is beyond current sheet row_count, add a blank row
-        if empty_id_row >= worksheet.row_count:
-            safe_gspread_call(worksheet.append_row, [""] * len(headers))
-
         # Build one row of data
         new_row_values = [""] * len(headers)
 
@@ -242,7 +557,13 @@ def import_notion_page(page, worksheet):
         end_a1   = rowcol_to_a1(empty_id_row, len(headers))  # e.g. "G5"
         row_range = f"{start_a1}:{end_a1}"
 
-        safe_gspread_call(worksheet.update, row_range, [new_row_values])
+        with own_snapshot_write(worksheet):
+            # If row is beyond current sheet row_count, add a blank row
+            if empty_id_row >= worksheet.row_count:
+                safe_gspread_call(worksheet.append_row, [""] * len(headers))
+
+            safe_gspread_call(worksheet.update, row_range, [new_row_values])
+            note_own_write(worksheet, empty_id_row, 1, new_row_values)
         return True
 
     else:
@@ -284,65 +605,100 @@ def import_notion_page(page, worksheet):
             end_a1   = rowcol_to_a1(row_number, len(headers))
             row_range = f"{start_a1}:{end_a1}"
 
-            safe_gspread_call(worksheet.update, row_range, [current_row_values], value_input_option="USER_ENTERED")
+            with own_snapshot_write(worksheet):
+                safe_gspread_call(worksheet.update, row_range, [current_row_values], value_input_option="USER_ENTERED")
+                note_own_write(worksheet, row_number, 1, current_row_values)
             return True
         else:
             return False
 
 # Assuming pages are in reverse order of date
 def bulk_import_notion_page(pages, worksheet, interval=100):
-    for page in pages[::-1]:
-        print(f"→ Importing page {page.get("id", "")} …")
-        import_notion_page(page, worksheet)
+    with own_snapshot_write(worksheet):  # one revision check for the whole import
+        for page in pages[::-1]:
+            print(f"→ Importing page {page.get('id', '')} …")
+            import_notion_page(page, worksheet)
         time.sleep(interval)
 
 
-def fetch_page_texts_to_analyse(worksheet):
+ANALYSE_STATUS_COLUMNS = ["to_analyse"]
+
+
+def is_pending_analysis(row: RecordRow) -> bool:
+    return row.to_analyse
+
+
+def get_rows_to_analyse(worksheet) -> List[RecordRow]:
     """
-    Retrieve two lists from the 'Record' sheet:
-      - page_ids: IDs for each row marked "to_analyse" == "TRUE"
-      - page_texts: corresponding content strings
-    
-    The sheet is assumed to have columns:
-      - id
-      - content
-      - to_analyse
-    in row 1 (header).
-    Any row with to_analyse == "TRUE" is included in the result (skipping the header).
+    Retrieve the rows marked to_analyse == TRUE as RecordRows carrying (row, id, content),
+    plus the lease columns when the sheet has them, so they can be leased.
+    With leasing, the rows are read fresh, bypassing the snapshot.
     """
+    leases = lease_columns(worksheet)
+    rows = read_record_rows(worksheet, ["id", "content"] + ANALYSE_STATUS_COLUMNS + leases, fresh=bool(leases))
+    return [row for row in rows if is_pending_analysis(row)]
 
-    # 1) Identify columns by name in the header row
-    headers = worksheet.row_values(1)
-    try:
-        id_col_idx = headers.index("id") + 1
-        content_col_idx = headers.index("content") + 1
-        to_analyse_col_idx = headers.index("to_analyse") + 1
-    except ValueError:
-        raise Exception("Required columns 'id', 'content' and 'to_analyse' not found in the first row.")
 
-    # 2) Get all data (including the header). We'll skip row 0 (header).
-    all_rows = worksheet.get_all_values()
-    
-    # 3) Build our lists of IDs and page_texts
-    page_ids = []
-    page_texts = []
-    
-    for row_idx in range(1, len(all_rows)):
-        row = all_rows[row_idx]
-        # Make sure the row has enough columns (defensive check)
-        if len(row) < max(id_col_idx, content_col_idx, to_analyse_col_idx):
+LABEL_SOURCE_INDEX_FILE = "label_sources.txt"
+
+
+def load_label_source_index() -> Dict[str, str]:
+    """
+    Load where each page's current label came from: {dash-less page id: source},
+    source being "deepseek", "local" (local classifier) or "duplicate" (copied by dedup).
+    Stored as "<page id> <source>" lines; the last line for a page wins.
+    """
+    path = local_state_path(LABEL_SOURCE_INDEX_FILE)
+    sources = {}
+    if not os.path.exists(path):
+        return sources
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 2:
+                sources[parts[0]] = parts[1]
+    return sources
+
+
+def add_to_label_source_index(ai_results):
+    """
+    Append the source of each written result to the local label-source index.
+    """
+    with open(local_state_path(LABEL_SOURCE_INDEX_FILE), "a", encoding="utf-8") as f:
+        for result in ai_results:
+            f.write(f"{result.get('page_id', '').replace('-', '')} {result.get('source', 'deepseek')}\n")
+
+
+def fetch_labelled_examples(worksheet):
+    """
+    Retrieve notes DeepSeek already classified (to_analyse == FALSE and ai_category set)
+    as training data for the local classifier.
+
+    Labels set by the local classifier or copied by dedup are skipped, so the classifier
+    never trains on its own output. The source is read from the optional "ai_source"
+    column, else from the local label-source index; rows with no recorded source
+    count as DeepSeek labels (every label before sources were recorded came from DeepSeek).
+
+    Returns three parallel lists: texts, categories, tag lists.
+    """
+    column_names = ["id", "content", "to_analyse", "ai_category", "ai_tags"]
+    if "ai_source" in get_sheet_headers(worksheet):
+        column_names.append("ai_source")
+    rows = read_record_rows(worksheet, column_names)
+    label_sources = load_label_source_index()
+
+    texts, categories, tags = [], [], []
+    for row in rows:
+        if row.to_analyse or not row.ai_category.strip() or not row.content.strip():
             continue
-        
-        id_val = row[id_col_idx - 1].strip()
-        text_val = row[content_col_idx - 1].strip()
-        to_analyse_val = row[to_analyse_col_idx - 1].strip().upper()  # e.g. "TRUE" or "FALSE"
-        
-        # If to_analyse == "TRUE", collect the id and content
-        if to_analyse_val == "TRUE":
-            page_ids.append(id_val)
-            page_texts.append(text_val)
-    
-    return page_ids, page_texts
+        source = row.ai_source.strip() or label_sources.get(row.id.strip().replace("-", ""), "")
+        if source in ("local", "duplicate"):
+            continue
+        texts.append(row.content.strip())
+        categories.append(row.ai_category.strip())
+        tags.append([t.strip() for t in row.ai_tags.split(",") if t.strip()])
+
+    return texts, categories, tags
 
 
 def update_ai_classification_in_record(worksheet, ai_results):
@@ -357,6 +713,7 @@ def update_ai_classification_in_record(worksheet, ai_results):
       - "ai_tags"
       - "has_lexical_suggestion"
       - "lexical_suggestion"
+    and optionally "ai_source".
 
     Each item in ai_results is a dict like:
       {
@@ -364,19 +721,23 @@ def update_ai_classification_in_record(worksheet, ai_results):
         "category": "Food",
         "tags": ["tag1", "tag2"],
         "has_lexical_suggestion": false,
-        "lexical_suggestion": ""
+        "lexical_suggestion": "",
+        "source": "deepseek"   # or "local" / "duplicate"
       }
 
     We locate the row by 'page_id' in the "id" column, then:
       1) Update ai_category, ai_tags, has_lexical_suggestion, lexical_suggestion 
          in one range update (they're adjacent columns).
       2) Set to_analyse = FALSE in a separate single-cell update.
+      3) Record the result's source in "ai_source" (if present) and in the
+         local label-source index (see fetch_labelled_examples).
 
     If a row isn't found, we print a warning to stderr.
     
     safe_gspread_call is a function, e.g. safe_gspread_call(func, *args, **kwargs),
     used to wrap the raw gspread calls to handle rate-limit/quota errors.
     """
+    from gspread.utils import rowcol_to_a1
 
     # 1) Read headers and find column indices
     headers = safe_gspread_call(worksheet.row_values, 1)
@@ -391,54 +752,69 @@ def update_ai_classification_in_record(worksheet, ai_results):
         raise Exception("Required columns are missing in the first row: "
                         "'id', 'to_analyse', 'ai_category', 'ai_tags', "
                         "'has_lexical_suggestion', 'lexical_suggestion'") from e
+    ai_source_col = headers.index("ai_source") + 1 if "ai_source" in headers else None
 
     # 2) For each AI result, locate the row by page_id and update
-    for result in ai_results:
-        page_id             = result.get("page_id", "")
-        category            = result.get("category", "Other")
-        tags_list           = result.get("tags", [])
-        has_lexical_sugg    = result.get("has_lexical_suggestion", False)
-        lexical_suggestion  = result.get("lexical_suggestion", "")
-
-        # Convert tags list to a comma-joined string
-        tags_str = ", ".join(tags_list)
+    with own_snapshot_write(worksheet):
+        for result in ai_results:
+            page_id             = result.get("page_id", "")
+            category            = result.get("category", "Other")
+            tags_list           = result.get("tags", [])
+            has_lexical_sugg    = result.get("has_lexical_suggestion", False)
+            lexical_suggestion  = result.get("lexical_suggestion", "")
 
-        # Convert booleans to strings (for user-entered checkboxes, etc.)
-        has_lex_sugg_str = "TRUE" if has_lexical_sugg else "FALSE"
+            # Convert tags list to a comma-joined string
+            tags_str = ", ".join(tags_list)
 
-        # 2a) Find the row for this page_id
-        try:
-            cell = safe_gspread_call(worksheet.find, page_id)
-        except ValueError:
-            cell = None
-
-        if not cell:
-            print(f"Warning: No row found for page_id {page_id}", file=sys.stderr)
-            continue
-
-        row_number = cell.row
-
-        # 2b) Update AI columns in one range
-        # We assume ai_category_col → lex_sugg_col are adjacent
-        update_values = [[category, tags_str, has_lex_sugg_str, lexical_suggestion]]
-        start_a1 = rowcol_to_a1(row_number, ai_category_col)
-        end_a1   = rowcol_to_a1(row_number, lex_sugg_col)
-        update_range = f"{start_a1}:{end_a1}"
-
-        safe_gspread_call(
-            worksheet.update,
-            update_range,
-            update_values,
-            value_input_option="USER_ENTERED"
-        )
+            # Convert booleans to strings (for user-entered checkboxes, etc.)
+            has_lex_sugg_str = "TRUE" if has_lexical_sugg else "FALSE"
 
-        # 2c) Set `to_analyse` = FALSE in a separate single-cell update
-        safe_gspread_call(
-            worksheet.update_cell,
-            row_number,
-            to_analyse_col,
-            "FALSE"
-        )
+            # 2a) Find the row for this page_id
+            try:
+                cell = safe_gspread_call(worksheet.find, page_id)
+            except ValueError:
+                cell = None
+
+            if not cell:
+                print(f"Warning: No row found for page_id {page_id}", file=sys.stderr)
+                continue
+
+            row_number = cell.row
+
+            # 2b) Update AI columns in one range
+            # We assume ai_category_col → lex_sugg_col are adjacent
+            update_values = [[category, tags_str, has_lex_sugg_str, lexical_suggestion]]
+            start_a1 = rowcol_to_a1(row_number, ai_category_col)
+            end_a1   = rowcol_to_a1(row_number, lex_sugg_col)
+            update_range = f"{start_a1}:{end_a1}"
+
+            safe_gspread_call(
+                worksheet.update,
+                update_range,
+                update_values,
+                value_input_option="USER_ENTERED"
+            )
+
+            # 2c) Set `to_analyse` = FALSE in a separate single-cell update
+            safe_gspread_call(
+                worksheet.update_cell,
+                row_number,
+                to_analyse_col,
+                "FALSE"
+            )
+
+            note_own_write(worksheet, row_number, ai_category_col, update_values[0])
+            note_own_write(worksheet, row_number, to_analyse_col, ["FALSE"])
+
+            # 2d) Where the label came from, so the local classifier only trains on DeepSeek labels
+            if ai_source_col:
+                source = result.get("source", "deepseek")
+                safe_gspread_call(worksheet.update_cell, row_number, ai_source_col, source)
+                note_own_write(worksheet, row_number, ai_source_col, [source])
+
+    # 3) Remember where each label came from
+    if ai_results:
+        add_to_label_source_index(ai_results)
 
 
 # --------
@@ -446,28 +822,23 @@ def update_ai_classification_in_record(worksheet, ai_results):
 # --------
 
 
-from typing import List, Tuple
+DISPATCH_STATUS_COLUMNS = ['ready_to_dispatch', 'dispatched']
+
 
-def get_rows_to_dispatch(worksheet) -> List[Tuple[int, str, str]]:
+def is_pending_dispatch(row: RecordRow) -> bool:
+    return row.ready_to_dispatch and not row.dispatched
+
+
+def get_rows_to_dispatch(worksheet) -> List[RecordRow]:
     """
     Scan the sheet for rows where ready_to_dispatch==TRUE and dispatched==FALSE.
-    Returns a list of tuples: (row_index, content_to_dispatch, link).
+    Returns RecordRows carrying (row, id, content_to_dispatch, link).
+    With leasing, the rows are read fresh, bypassing the snapshot.
     """
-    # first fetch all values once
-    data = worksheet.get_all_values()
-    headers = data[0]
-    # map names to 1-based column indices
-    col = {name: i+1 for i, name in enumerate(headers)}
-
-    rows = []
-    for r, row in enumerate(data[1:], start=2):
-        ready = row[col['ready_to_dispatch'] - 1].strip().lower() in ('true', '1')
-        sent  = row[col['dispatched']         - 1].strip().lower() in ('true', '1')
-        if ready and not sent:
-            content = row[col['content_to_dispatch'] - 1]
-            link    = row[col['link']               - 1]
-            rows.append((r, content, link))
-    return rows
+    leases = lease_columns(worksheet)
+    rows = read_record_rows(worksheet, ['id', 'content_to_dispatch', 'link'] + DISPATCH_STATUS_COLUMNS + leases,
+                            fresh=bool(leases))
+    return [row for row in rows if is_pending_dispatch(row)]
 
 
 def mark_dispatched(worksheet, row_idx: int):
@@ -478,34 +849,25 @@ def mark_dispatched(worksheet, row_idx: int):
     # find the 'dispatched' column index
     headers = worksheet.row_values(1)
     disp_col = headers.index('dispatched') + 1
-    safe_gspread_call(worksheet.update_cell, row_idx, disp_col, 'TRUE')
+    with own_snapshot_write(worksheet):
+        safe_gspread_call(worksheet.update_cell, row_idx, disp_col, 'TRUE')
+        note_own_write(worksheet, row_idx, disp_col, ['TRUE'])
 
 
 # -------
 # Archive
 # -------
 
-def get_rows_to_archive(worksheet) -> List[Tuple[int, str]]:
+def get_rows_to_archive(worksheet) -> List[RecordRow]:
     """
     Scan the sheet for rows where
       - dispatched == TRUE
       - source_archived == FALSE
 
-    Returns a list of tuples: (row_index, record_id).
+    Returns RecordRows carrying (row, id).
     """
-    data    = worksheet.get_all_values()
-    headers = data[0]
-    # map header name → 1-based column index
-    col = {name: i + 1 for i, name in enumerate(headers)}
-
-    rows = []
-    for r, row in enumerate(data[1:], start=2):
-        dispatched     = row[col['dispatched']       - 1].strip().lower() in ('true', '1')
-        source_archived = row[col['source_archived'] - 1].strip().lower() in ('true', '1')
-        if dispatched and not source_archived:
-            record_id = row[col['id'] - 1]
-            rows.append((r, record_id))
-    return rows
+    rows = read_record_rows(worksheet, ['dispatched', 'source_archived', 'id'])
+    return [row for row in rows if row.dispatched and not row.source_archived]
 
 
 def mark_source_archived(worksheet, row_idx: int):
@@ -516,4 +878,323 @@ def mark_source_archived(worksheet, row_idx: int):
     # find the 'source_archived' column index
     headers      = worksheet.row_values(1)
     archived_col = headers.index('source_archived') + 1
-    safe_gspread_call(worksheet.update_cell, row_idx, archived_col, 'TRUE')
\ No newline at end of file
+    with own_snapshot_write(worksheet):
+        safe_gspread_call(worksheet.update_cell, row_idx, archived_col, 'TRUE')
+        note_own_write(worksheet, row_idx, archived_col, ['TRUE'])
+
+
+# ----------
+# Compaction
+# ----------
+
+ARCHIVED_ID_INDEX_FILE = "archived_ids.txt"
+ARCHIVE_WORKSHEET_PREFIX = "Archive"
+
+
+def load_archived_id_index() -> set:
+    """
+    Load the local index of page ids already moved out of the 'Record' sheet.
+    Stored as one dash-less page id per line, so lookups never need the archive sheets.
+    """
+    path = local_state_path(ARCHIVED_ID_INDEX_FILE)
+    if not os.path.exists(path):
+        return set()
+    with open(path, encoding="utf-8") as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+def add_to_archived_id_index(page_ids):
+    """
+    Append page ids to the local archived-id index.
+    """
+    with open(local_state_path(ARCHIVED_ID_INDEX_FILE), "a", encoding="utf-8") as f:
+        for page_id in page_ids:
+            f.write(page_id.replace("-", "") + "\n")
+
+
+def is_archived_page_id(page_id, archived_ids=None) -> bool:
+    """
+    Whether page_id was compacted out of the 'Record' sheet by compact_record_sheet.
+    """
+    if archived_ids is None:
+        archived_ids = load_archived_id_index()
+    return page_id.replace("-", "") in archived_ids
+
+
+def retrieve_or_create_worksheet(worksheet_name, headers):
+    """
+    Retrieve a worksheet by title, creating it with the given header row if it doesn't exist.
+    """
+    from gspread.exceptions import WorksheetNotFound
+
+    spreadsheet = get_notion_spreadsheet()
+    try:
+        return spreadsheet.worksheet(worksheet_name)
+    except WorksheetNotFound:
+        worksheet = safe_gspread_call(spreadsheet.add_worksheet, title=worksheet_name,
+                                      rows=1, cols=len(headers))
+        safe_gspread_call(worksheet.update, "A1", [headers], value_input_option="RAW")
+        return worksheet
+
+
+def compact_record_sheet(worksheet, archive_worksheet_name=None) -> int:
+    """
+    Move fully completed rows (dispatched == TRUE and source_archived == TRUE)
+    out of the 'Record' sheet into a dated archive worksheet, e.g. "Archive 2025-05".
+
+    Done in bulk: one full read, one append to the archive sheet, and one
+    batch_update deleting the finished rows bottom-up. Deleting rows (rather than
+    rewriting the sheet) leaves formulas and ARRAYFORMULA ranges of the other rows intact.
+    If the id column changed since the read (e.g. a concurrent import), nothing is deleted.
+    Archived ids are recorded in the local id index, so re-imported pages are still recognised.
+
+    Returns the number of rows moved.
+    """
+    from datetime import date
+
+    if archive_worksheet_name is None:
+        archive_worksheet_name = f"{ARCHIVE_WORKSHEET_PREFIX} {date.today():%Y-%m}"
+
+    data = safe_gspread_call(worksheet.get_all_values)
+    if not data:
+        return 0
+    headers = data[0]
+    try:
+        id_col = headers.index("id")
+        dispatched_col = headers.index("dispatched")
+        archived_col = headers.index("source_archived")
+    except ValueError:
+        raise Exception("Required columns 'id', 'dispatched' and 'source_archived' not found in the first row.")
+
+    keep_rows, done_rows = [], []  # done_rows: (sheet row number, values)
+    for i, row in enumerate(data[1:], start=2):
+        row = row + [""] * (len(headers) - len(row))
+        if parse_sheet_bool(row[dispatched_col]) and parse_sheet_bool(row[archived_col]):
+            done_rows.append((i, row))
+        elif any(cell.strip() for cell in row):
+            keep_rows.append(row)
+
+    if not done_rows:
+        return 0
+
+    # Compaction renumbers rows, which would invalidate the row numbers other workers hold leases on
+    if "lease_owner" in headers and "lease_expires" in headers:
+        now = datetime.now(timezone.utc)
+        owner_col, expires_col = headers.index("lease_owner"), headers.index("lease_expires")
+        if any(row[owner_col] and not is_lease_expired(row[expires_col], now) for row in keep_rows):
+            raise Exception("Rows are leased by running workers; stop them before compacting the Record sheet.")
+
+    # 1) Append to the archive sheet first; skip ids a previous, interrupted compaction already moved.
+    #    RAW keeps the displayed values verbatim (no re-parsing of "=…", "1/2", leading zeros).
+    archived_ids = load_archived_id_index()
+    new_done_rows = [row for _, row in done_rows if not is_archived_page_id(row[id_col], archived_ids)]
+    if new_done_rows:
+        archive_worksheet = retrieve_or_create_worksheet(archive_worksheet_name, headers)
+        safe_gspread_call(archive_worksheet.append_rows, new_done_rows, value_input_option="RAW")
+        add_to_archived_id_index(row[id_col] for row in new_done_rows)
+
+    # 2) Re-read the ids just before deleting: abort if any row moved in the meantime.
+    #    The archived rows are recorded, so the next compaction only deletes them.
+    current_ids = safe_gspread_call(worksheet.col_values, id_col + 1)
+    expected_ids = [row[id_col] if id_col < len(row) else "" for row in data]
+    while expected_ids and not expected_ids[-1]:
+        expected_ids.pop()  # col_values drops trailing empty cells
+    if current_ids != expected_ids:
+        drop_sheet_snapshot(worksheet)
+        raise Exception("The Record sheet changed during compaction; nothing was deleted, run it again.")
+
+    # 3) Delete the finished rows in one batch_update, bottom-up so row numbers stay valid
+    ranges = []  # [start, end) 0-based, merged when contiguous
+    for row_number, _ in sorted(done_rows, reverse=True):
+        if ranges and ranges[-1][0] == row_number:
+            ranges[-1][0] = row_number - 1
+        else:
+            ranges.append([row_number - 1, row_number])
+    with own_snapshot_write(worksheet):
+        safe_gspread_call(worksheet.spreadsheet.batch_update, {"requests": [
+            {"deleteDimension": {"range": {
+                "sheetId": worksheet.id, "dimension": "ROWS", "startIndex": start, "endIndex": end,
+            }}}
+            for start, end in ranges
+        ]})
+        drop_sheet_snapshot(worksheet)
+
+    return len(done_rows)
+
+# -------
+# Leasing
+# -------
+
+# Several dispatch / AI workers (processes or hosts) can share the Record sheet:
+# each claims a slice of pending rows by writing its id and an expiry time into
+# the optional 'lease_owner' / 'lease_expires' columns, renews while working, and
+# releases when done. Rows whose lease expired (crashed worker) are claimable again.
+# Sheets has no compare-and-set, so a claim is written, left to settle, and
+# read back; only rows still carrying our id and still pending are kept.
+# Renew and release only touch rows still carrying our id, and a worker checks
+# held_leases right before acting on a row. Lease reads always bypass the snapshot cache.
+LEASE_DURATION_SECONDS = 600
+LEASE_SETTLE_SECONDS = 5
+LEASE_BATCH_ROWS = 50          # How many rows a worker claims at once
+LEASE_TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+def new_lease_owner_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def lease_columns(worksheet) -> List[str]:
+    """
+    ['lease_owner', 'lease_expires'] if the sheet has both columns, else [] (leasing disabled).
+    """
+    headers = get_sheet_headers(worksheet)
+    if "lease_owner" in headers and "lease_expires" in headers:
+        return ["lease_owner", "lease_expires"]
+    return []
+
+
+def is_lease_expired(lease_expires, now=None) -> bool:
+    if not lease_expires.strip():
+        return True
+    try:
+        expires = datetime.strptime(lease_expires.strip(), LEASE_TIME_FORMAT).replace(tzinfo=timezone.utc)
+    except ValueError:
+        return True  # unreadable lease: treat as abandoned
+    return expires <= (now or datetime.now(timezone.utc))
+
+
+def _write_leases(worksheet, rows, owner, expires):
+    # Lease columns are always read fresh, so lease writes bypass the snapshot
+    from gspread.utils import rowcol_to_a1
+
+    headers = get_sheet_headers(worksheet)
+    owner_col = headers.index("lease_owner") + 1
+    expires_col = headers.index("lease_expires") + 1
+    data = []
+    for row in rows:
+        data.append({"range": rowcol_to_a1(row.row, owner_col), "values": [[owner]]})
+        data.append({"range": rowcol_to_a1(row.row, expires_col), "values": [[expires]]})
+    safe_gspread_call(worksheet.batch_update, data, value_input_option="RAW")
+
+
+def _read_leases(worksheet, status_columns=()) -> List[RecordRow]:
+    # id, lease and status columns, read fresh
+    return read_record_rows(worksheet, ["id", "lease_owner", "lease_expires"] + list(status_columns), fresh=True)
+
+
+def _current_row(current: List[RecordRow], row: RecordRow):
+    # The freshly read version of `row`, or None if it no longer holds the same note
+    back = current[row.row - 2] if 2 <= row.row < len(current) + 2 else None
+    if back is None or (row.id and back.id != row.id):
+        return None
+    return back
+
+
+def held_leases(worksheet, rows: List[RecordRow], owner) -> List[RecordRow]:
+    """
+    The rows whose lease `owner` still holds (read fresh, not expired).
+    Check this right before acting on a row: another worker may have taken
+    the row over, e.g. after our lease expired while we were stalled.
+    """
+    if not rows or not lease_columns(worksheet):
+        return rows
+    current = _read_leases(worksheet)
+    now = datetime.now(timezone.utc)
+    held = []
+    for row in rows:
+        back = _current_row(current, row)
+        if back is not None and back.lease_owner == owner and not is_lease_expired(back.lease_expires, now):
+            held.append(row)
+    return held
+
+
+def claim_rows(worksheet, rows: List[RecordRow], owner, status_columns=(), is_pending=None,
+               limit=LEASE_BATCH_ROWS) -> List[RecordRow]:
+    """
+    Lease up to `limit` of the given pending rows for `owner`.
+    Rows leased by another worker are skipped unless that lease expired.
+
+    The lease columns are re-read fresh right before the claim is written. If the write
+    itself lands late (e.g. after quota back-off), it may have overwritten a claim made
+    meanwhile, so it is withdrawn. After the claim settles, the owner, id and
+    `status_columns` are read back fresh; a row is kept only if it still carries our id,
+    still holds the same note, and still satisfies `is_pending` (e.g. is_pending_analysis /
+    is_pending_dispatch), so rows another worker finished in the meantime are not processed twice.
+
+    Returns the rows this worker now holds. If the sheet has no lease
+    columns, leasing is disabled and all rows are returned unchanged.
+    """
+    if not lease_columns(worksheet):
+        return rows
+
+    def claimable(back, now):
+        return (back is not None and (not back.lease_owner or is_lease_expired(back.lease_expires, now))
+                and (is_pending is None or is_pending(back)))
+
+    now = datetime.now(timezone.utc)
+    candidates = [row for row in rows if not row.lease_owner or is_lease_expired(row.lease_expires, now)]
+    if not candidates:
+        return []
+
+    # Re-check just before writing; from here until the write lands must stay within LEASE_SETTLE_SECONDS
+    current = _read_leases(worksheet, status_columns)
+    checked_at = time.monotonic()
+    now = datetime.now(timezone.utc)
+    free = [row for row in candidates if claimable(_current_row(current, row), now)][:limit]
+    if not free:
+        return []
+
+    expires = (now + timedelta(seconds=LEASE_DURATION_SECONDS)).strftime(LEASE_TIME_FORMAT)
+    _write_leases(worksheet, free, owner, expires)
+    if time.monotonic() - checked_at > LEASE_SETTLE_SECONDS:
+        print("Lease claim landed late; withdrawing it.")
+        release_leases(worksheet, free, owner)
+        return []
+
+    # Read back fresh (not from the snapshot): a competing claim wins if it landed later
+    time.sleep(LEASE_SETTLE_SECONDS)
+    current = _read_leases(worksheet, status_columns)
+    claimed, finished = [], []
+    for row in free:
+        back = current[row.row - 2] if row.row - 2 < len(current) else None
+        if back is None or back.lease_owner != owner:
+            continue
+        if (row.id and back.id != row.id) or (is_pending is not None and not is_pending(back)):
+            finished.append(row)  # ours, but nothing left to do: give it back right away
+            continue
+        claimed.append(row)
+    if finished:
+        release_leases(worksheet, finished, owner)
+    if len(claimed) < len(free):
+        print(f"{len(free) - len(claimed)} rows were claimed or finished by another worker.")
+    return claimed
+
+
+def renew_leases(worksheet, rows: List[RecordRow], owner) -> List[RecordRow]:
+    """
+    Push the expiry of this worker's leases forward by LEASE_DURATION_SECONDS.
+    Rows this worker no longer holds (taken over, or our lease already expired)
+    are left alone and dropped. Returns the rows still held.
+    """
+    if not rows or not lease_columns(worksheet):
+        return rows
+    held = held_leases(worksheet, rows, owner)
+    if len(held) < len(rows):
+        print(f"{len(rows) - len(held)} leases were lost to another worker.")
+    if held:
+        expires = (datetime.now(timezone.utc) + timedelta(seconds=LEASE_DURATION_SECONDS)).strftime(LEASE_TIME_FORMAT)
+        _write_leases(worksheet, held, owner, expires)
+    return held
+
+
+def release_leases(worksheet, rows: List[RecordRow], owner):
+    """
+    Clear the leases on rows this worker is done with (finished or not).
+    Rows now leased by another worker are left alone.
+    """
+    if not rows or not lease_columns(worksheet):
+        return
+    current = _read_leases(worksheet)
+    ours = [row for row in rows if (_current_row(current, row) or RecordRow(row=row.row)).lease_owner == owner]
+    if ours:
+        _write_leases(worksheet, ours, "", "")
@@ -0,0 +1,92 @@
+import os
+import re
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import ai_analysis  # noqa: E402
+from ai_analysis import (decode_batch_results, group_categories, route_notes, summarize_groups,  # noqa: E402
+                         CATEGORY_GROUP_SIZE, CATEGORY_ROUTING_SUMMARY_LABELS)
+
+BATCH_IDS = ["page-1", "page-2", "page-3"]
+CATEGORIES = [{"label": "Food", "description": ""}, {"label": "Travel", "description": ""}]
+
+
+def test_decode_maps_rows_back_to_page_ids():
+    results = decode_batch_results(BATCH_IDS, [[2, "Travel", ["rome"], "Fixed text"], [1, "Food", []]], CATEGORIES)
+    assert results == [
+        {"page_id": "page-2", "category": "Travel", "tags": ["rome"],
+         "has_lexical_suggestion": True, "lexical_suggestion": "Fixed text", "source": "deepseek"},
+        {"page_id": "page-1", "category": "Food", "tags": [],
+         "has_lexical_suggestion": False, "lexical_suggestion": "", "source": "deepseek"},
+    ]
+
+
+def test_decode_drops_out_of_range_and_repeated_indexes():
+    rows = [[0, "Food", []], [4, "Food", []], [-1, "Food", []], [1, "Food", []], [1, "Travel", []]]
+    results = decode_batch_results(BATCH_IDS, rows, CATEGORIES)
+    assert [(r["page_id"], r["category"]) for r in results] == [("page-1", "Food")]
+
+
+def test_decode_drops_malformed_rows():
+    rows = [
+        "1, Food",                 # not a list
+        [1, "Food"],               # too short
+        ["1", "Food", []],         # index not an int
+        [True, "Food", []],        # bool is not an index
+        [2, 3, []],                # category not a string
+        [3, "Food", "tag"],        # tags not a list
+    ]
+    assert decode_batch_results(BATCH_IDS, rows, CATEGORIES) == []
+
+
+def test_decode_maps_unknown_categories_to_other():
+    results = decode_batch_results(BATCH_IDS, [[1, "Gardening", []]], CATEGORIES)
+    assert results[0]["category"] == "Other"
+
+
+def test_decode_rejects_replies_that_are_not_arrays():
+    assert decode_batch_results(BATCH_IDS, "not json", CATEGORIES) == []
+    assert decode_batch_results(BATCH_IDS, {"1": "Food"}, CATEGORIES) == []
+
+
+def many_categories(n, group=None):
+    return [{"label": f"Label{i}", "description": f"topic{i % 7} area{i % 11}", "group": group}
+            for i in range(n)]
+
+
+def test_groups_are_capped_and_oversized_manual_groups_are_split():
+    groups = group_categories(many_categories(250))
+    assert max(len(members) for members in groups.values()) <= CATEGORY_GROUP_SIZE
+    assert sum(len(members) for members in groups.values()) == 250
+
+    manual = group_categories(many_categories(23, group="Big") + [{"label": "X", "description": "", "group": "Small"}])
+    assert {name: len(members) for name, members in manual.items()} == {
+        "Big (1)": 10, "Big (2)": 10, "Big (3)": 3, "Small": 1}
+
+
+def test_group_summaries_are_bounded():
+    summary = summarize_groups({"G1": many_categories(40)})
+    assert summary.count(",") == CATEGORY_ROUTING_SUMMARY_LABELS - 1
+    assert summary.endswith(f"(+{40 - CATEGORY_ROUTING_SUMMARY_LABELS} more)")
+
+
+def test_routing_prompts_never_offer_more_than_group_size_options(monkeypatch):
+    groups = group_categories(many_categories(2000))
+    option_counts = []
+
+    def fake_ai(prompt):
+        _, user_content = prompt
+        options = re.findall(r'^• "([^"]+)"', user_content, flags=re.MULTILINE)
+        option_counts.append(len(options))
+        n_items = len(re.findall(r"^\d+\) ", user_content, flags=re.MULTILINE))
+        return [[i, options[-1]] for i in range(1, n_items + 1)]  # always the last option: deepest path
+
+    monkeypatch.setattr(ai_analysis, "send_to_deepseek_ai", fake_ai)
+    routed = route_notes(["page-1", "page-2"], ["note one", "note two"], groups, max_chars_per_batch=6000)
+
+    assert len(option_counts) > 1  # 200 groups: routed through bundles first
+    assert max(option_counts) <= CATEGORY_GROUP_SIZE
+    (group_name, (ids, texts)), = routed.items()
+    assert group_name in groups and ids == ["page-1", "page-2"] and texts == ["note one", "note two"]
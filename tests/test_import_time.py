@@ -0,0 +1,27 @@
+import json
+import os
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Importing main must not build clients or pull in heavy third-party packages
+HEAVY_MODULES = ["gspread", "openai", "selenium", "notion_client", "requests", "dotenv"]
+IMPORT_TIME_LIMIT_SECONDS = 1.0
+
+
+def test_import_main_is_fast_and_side_effect_free():
+    script = (
+        "import json, sys, time\n"
+        "start = time.perf_counter()\n"
+        "import main\n"
+        "elapsed = time.perf_counter() - start\n"
+        f"loaded = [m for m in {HEAVY_MODULES!r} if m in sys.modules]\n"
+        "print(json.dumps({'elapsed': elapsed, 'loaded': loaded}))\n"
+    )
+    result = subprocess.run([sys.executable, "-c", script], cwd=REPO_ROOT,
+                            capture_output=True, text=True, check=True)
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+
+    assert report["loaded"] == []
+    assert report["elapsed"] < IMPORT_TIME_LIMIT_SECONDS
@@ -0,0 +1,131 @@
+import json
+import os
+import socket
+import sys
+import threading
+import urllib.error
+import urllib.request
+from datetime import datetime, timedelta, timezone
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import webhook_receiver  # noqa: E402
+from webhook_receiver import run_webhook_receiver, send_test_event, sign_notion_payload  # noqa: E402
+
+SECRET = "test-secret"
+PAGE_ID = "18c81f71-36d9-8029-a648-d1a99893724b"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_receiver(fetch_pages, import_pages):
+    port = free_port()
+    stop, ready = threading.Event(), threading.Event()
+    thread = threading.Thread(target=run_webhook_receiver, daemon=True, kwargs=dict(
+        port=port, secret=SECRET, fetch_pages=fetch_pages, import_pages=import_pages,
+        reconcile=None, stop_event=stop, ready=ready))
+    thread.start()
+    assert ready.wait(5)
+    return port, stop, thread
+
+
+def post(port, body, signature=None):
+    headers = {"Content-Type": "application/json"}
+    if signature:
+        headers["X-Notion-Signature"] = signature
+    request = urllib.request.Request(f"http://127.0.0.1:{port}/", data=body, method="POST", headers=headers)
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def test_signed_event_is_imported(monkeypatch):
+    monkeypatch.setattr(webhook_receiver, "WEBHOOK_COALESCE_SECONDS", 0.1)
+    imported = []
+    done = threading.Event()
+
+    def import_pages(pages):
+        imported.extend(pages)
+        done.set()
+
+    port, stop, thread = start_receiver(lambda ids: [{"id": i} for i in ids], import_pages)
+    try:
+        assert send_test_event(PAGE_ID, port=port, secret=SECRET) == 200
+        assert done.wait(5)
+        assert imported == [{"id": PAGE_ID}]
+    finally:
+        stop.set()
+        thread.join(5)
+
+
+def test_bad_signature_and_non_object_payloads_are_rejected(monkeypatch):
+    monkeypatch.setattr(webhook_receiver, "WEBHOOK_COALESCE_SECONDS", 0.1)
+    imported = []
+    port, stop, thread = start_receiver(lambda ids: [{"id": i} for i in ids], imported.extend)
+    try:
+        event = json.dumps({"type": "page.created", "entity": {"id": PAGE_ID, "type": "page"}}).encode("utf-8")
+        assert post(port, event, sign_notion_payload(event, "wrong-secret")) == 401
+        for body in (b"[1, 2]", b"42", b"not json"):
+            assert post(port, body, sign_notion_payload(body, SECRET)) == 400
+        assert not imported
+    finally:
+        stop.set()
+        thread.join(5)
+
+
+def test_failed_import_is_retried(monkeypatch):
+    monkeypatch.setattr(webhook_receiver, "WEBHOOK_COALESCE_SECONDS", 0.1)
+    monkeypatch.setattr(webhook_receiver, "WEBHOOK_RETRY_SECONDS", 0.1)
+    attempts = []
+    done = threading.Event()
+
+    def import_pages(pages):
+        attempts.append(pages)
+        if len(attempts) == 1:
+            raise RuntimeError("Sheets quota exceeded")
+        done.set()
+
+    port, stop, thread = start_receiver(lambda ids: [{"id": i} for i in ids], import_pages)
+    try:
+        assert send_test_event(PAGE_ID, port=port, secret=SECRET) == 200
+        assert done.wait(5)
+        assert attempts == [[{"id": PAGE_ID}], [{"id": PAGE_ID}]]
+        assert thread.is_alive()
+    finally:
+        stop.set()
+        thread.join(5)
+
+
+def test_reconciliation_resumes_from_saved_time(monkeypatch, tmp_path):
+    monkeypatch.setattr(webhook_receiver, "local_state_path", lambda filename: str(tmp_path / filename))
+    saved = datetime(2025, 5, 1, 12, 0, tzinfo=timezone.utc)
+    webhook_receiver.save_last_reconcile(saved)
+
+    windows = []
+    done = threading.Event()
+
+    def reconcile(since):
+        windows.append(since)
+        done.set()
+        return []
+
+    port = free_port()
+    stop, ready = threading.Event(), threading.Event()
+    thread = threading.Thread(target=run_webhook_receiver, daemon=True, kwargs=dict(
+        port=port, secret=SECRET, fetch_pages=lambda ids: [], import_pages=lambda pages: None,
+        reconcile=reconcile, stop_event=stop, ready=ready))
+    thread.start()
+    try:
+        assert done.wait(5)
+        assert windows == [saved - timedelta(seconds=webhook_receiver.WEBHOOK_RECONCILE_OVERLAP)]
+    finally:
+        stop.set()
+        thread.join(5)
+    assert webhook_receiver.load_last_reconcile() > saved
@@ -1,6 +1,8 @@
+import os
 import json
 import re
-from itertools import accumulate
+import time
+from contextlib import contextmanager
 
 def parse_markdown_json(markdown_text):
     """
@@ -48,16 +50,58 @@ def chunk_page_items(page_ids, page_texts, max_chars_per_batch):
     total length of the concatenated texts in each batch
     is <= max_chars_per_batch.
     """
-    # precompute lengths of each text
-    lengths = [len(t) for t in page_texts]
     batches = []
     start = 0
-    for i, total in enumerate(accumulate(lengths), start=1):
-        # if adding this item would overflow
-        if total - (accumulate(lengths)[start] if start>0 else 0) > max_chars_per_batch:
-            # close out previous batch
-            batches.append((page_ids[start:i-1], page_texts[start:i-1]))
-            start = i - 1
+    total = 0
+    for i, text in enumerate(page_texts):
+        # if adding this item would overflow, close out the previous batch
+        # (a single over-long text still gets a batch of its own)
+        if total + len(text) > max_chars_per_batch and i > start:
+            batches.append((page_ids[start:i], page_texts[start:i]))
+            start = i
+            total = 0
+        total += len(text)
     # add final batch
-    batches.append((page_ids[start:], page_texts[start:]))
-    return batches
\ No newline at end of file
+    if start < len(page_texts):
+        batches.append((page_ids[start:], page_texts[start:]))
+    return batches
+
+
+LOCAL_STATE_DIR = "local_state"  # Local caches / indexes kept between runs (git-ignored)
+
+def local_state_path(filename):
+    """
+    Return the path of a file under LOCAL_STATE_DIR, creating the directory if needed.
+    """
+    os.makedirs(LOCAL_STATE_DIR, exist_ok=True)
+    return os.path.join(LOCAL_STATE_DIR, filename)
+
+
+LOCAL_STATE_LOCK_STALE_SECONDS = 60  # A lock older than this was left by a crashed process
+
+@contextmanager
+def local_state_lock(filename, timeout=30):
+    """
+    Hold an exclusive lock on a LOCAL_STATE_DIR file across processes (a "<filename>.lock"
+    file created with O_EXCL), for read-modify-write updates by several workers on one host.
+    """
+    lock_path = local_state_path(filename) + ".lock"
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > LOCAL_STATE_LOCK_STALE_SECONDS:
+                    os.remove(lock_path)
+                    continue
+            except OSError:
+                continue  # released meanwhile
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Timed out waiting for {lock_path}")
+            time.sleep(0.05)
+    try:
+        yield
+    finally:
+        os.remove(lock_path)
@@ -0,0 +1,275 @@
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+import config
+from utils import local_state_path
+
+# Push-based ingestion: Notion integration webhooks POST page events here. Events are
+# verified, coalesced for a few seconds, and only the affected pages are fetched and
+# imported. A periodic reconciliation crawl of recently edited pages catches missed events.
+WEBHOOK_PORT = 8787
+WEBHOOK_PAGE_EVENTS = {"page.created", "page.content_updated", "page.properties_updated", "page.undeleted"}
+WEBHOOK_COALESCE_SECONDS = 2       # Import once no new event arrived for this long…
+WEBHOOK_MAX_DELAY_SECONDS = 10     # …but never hold an event longer than this
+WEBHOOK_RECONCILE_SECONDS = 3600   # How often to crawl recently edited pages
+WEBHOOK_RECONCILE_OVERLAP = 300    # Re-crawl this many seconds before the last reconciliation
+WEBHOOK_RETRY_SECONDS = 30         # Back-off after a failed import or reconciliation
+WEBHOOK_RECONCILE_STATE_FILE = "webhook_last_reconcile.txt"
+
+
+def sign_notion_payload(body: bytes, secret) -> str:
+    """
+    The X-Notion-Signature value Notion sends for body: "sha256=" + HMAC-SHA256(verification_token, body).
+    """
+    return "sha256=" + hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+
+
+def verify_notion_signature(body: bytes, signature, secret) -> bool:
+    if not signature or not secret:
+        return False
+    return hmac.compare_digest(sign_notion_payload(body, secret), signature)
+
+
+class PageEventQueue:
+    """
+    Collects page ids from webhook events; take_batch hands them out in coalesced bursts,
+    so several edits of the same note are imported once.
+    """
+    def __init__(self):
+        self.page_ids = set()
+        self.first_event = None
+        self.last_event = None
+        self.condition = threading.Condition()
+
+    def add(self, page_id):
+        self.add_many([page_id])
+
+    def add_many(self, page_ids):
+        with self.condition:
+            now = time.monotonic()
+            self.page_ids.update(page_ids)
+            self.first_event = self.first_event or now
+            self.last_event = now
+            self.condition.notify()
+
+    def take_batch(self, timeout):
+        """
+        Wait up to `timeout` seconds for events, then until the burst settles.
+        Returns the set of page ids (possibly empty).
+        """
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while not self.page_ids:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return set()
+                self.condition.wait(remaining)
+            while True:
+                now = time.monotonic()
+                settle_at = min(self.last_event + WEBHOOK_COALESCE_SECONDS,
+                                self.first_event + WEBHOOK_MAX_DELAY_SECONDS)
+                if now >= settle_at:
+                    break
+                self.condition.wait(settle_at - now)
+            page_ids, self.page_ids = self.page_ids, set()
+            self.first_event = self.last_event = None
+            return page_ids
+
+
+def make_webhook_handler(events: PageEventQueue, secret):
+    from http.server import BaseHTTPRequestHandler
+
+    class NotionWebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            try:
+                payload = json.loads(body)
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                payload = None
+            if not isinstance(payload, dict):
+                self.send_response(400)
+                self.end_headers()
+                return
+
+            # One-off subscription handshake: Notion sends the verification_token unsigned
+            if "verification_token" in payload and not self.headers.get("X-Notion-Signature"):
+                print(f"[Webhook] Verification token received: {payload['verification_token']} "
+                      f"(set it as NOTION_WEBHOOK_SECRET and confirm it in Notion)")
+                self.send_response(200)
+                self.end_headers()
+                return
+
+            if not verify_notion_signature(body, self.headers.get("X-Notion-Signature"), secret):
+                self.send_response(401)
+                self.end_headers()
+                return
+
+            entity = payload.get("entity")
+            if (payload.get("type") in WEBHOOK_PAGE_EVENTS and isinstance(entity, dict)
+                    and entity.get("type") == "page" and isinstance(entity.get("id"), str) and entity["id"]):
+                events.add(entity["id"])
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass  # keep the console for import progress
+
+    return NotionWebhookHandler
+
+
+def import_pages_to_sheet(pages):
+    """
+    Default import: write pages into the Record sheet (no pacing; bursts are small).
+    """
+    from sheets_api import (retrieve_notion_worksheet, import_notion_page, start_sheet_snapshot_session,
+                            own_snapshot_write, NOTION_DISPATCHER_WORKSHEET_NAME_RECORD)
+
+    start_sheet_snapshot_session()
+    worksheet = retrieve_notion_worksheet(NOTION_DISPATCHER_WORKSHEET_NAME_RECORD)
+    with own_snapshot_write(worksheet):
+        for page in pages:
+            print(f"→ Importing page {page.get('id', '')} …")
+            import_notion_page(page, worksheet)
+
+
+def reconcile_recent_pages(since):
+    """
+    Crawl pages edited since `since` (timezone-aware datetime), for events that never arrived.
+    Returns them most recently edited first. Requests time out, retry 429 / 5xx and
+    share the process-wide Notion rate limiter (see notion_api.post_notion_query).
+    """
+    import requests
+    from notion_api import post_notion_query, shared_rate_limiter
+
+    session = requests.Session()
+    payload = {
+        "page_size": 100,
+        "filter": {"timestamp": "last_edited_time", "last_edited_time": {"on_or_after": since.isoformat()}},
+        "sorts": [{"timestamp": "last_edited_time", "direction": "descending"}],
+    }
+    pages = []
+    while True:
+        data = post_notion_query(session, payload, shared_rate_limiter())
+        pages.extend(data["results"])
+        if not data.get("has_more"):
+            return pages
+        payload["start_cursor"] = data["next_cursor"]
+
+
+def load_last_reconcile():
+    """
+    When the last successful reconciliation started (saved across restarts), or None.
+    """
+    try:
+        with open(local_state_path(WEBHOOK_RECONCILE_STATE_FILE), encoding="utf-8") as f:
+            return datetime.fromisoformat(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def save_last_reconcile(started):
+    path = local_state_path(WEBHOOK_RECONCILE_STATE_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        f.write(started.isoformat())
+    os.replace(path + ".tmp", path)
+
+
+def run_webhook_receiver(port=WEBHOOK_PORT, secret=None, fetch_pages=None, import_pages=None,
+                         reconcile=reconcile_recent_pages, reconcile_seconds=WEBHOOK_RECONCILE_SECONDS,
+                         stop_event=None, ready=None):
+    """
+    Serve Notion webhooks on localhost:port (put a tunnel / reverse proxy in front of it)
+    and import affected pages as events settle. Blocks until stop_event is set;
+    `ready` (a threading.Event), if given, is set once the port is bound and accepting events.
+
+    - fetch_pages(page_ids) -> pages: defaults to notion_api.retrieve_notion_pages
+    - import_pages(pages): defaults to import_pages_to_sheet
+    - reconcile(since) -> pages: None disables reconciliation; the first crawl runs at startup
+      and covers everything edited since the last successful reconciliation, even across restarts
+
+    A failing batch (Notion / Sheets errors) is logged and its page ids are queued again;
+    a failing reconciliation is retried. Both back off WEBHOOK_RETRY_SECONDS, and the
+    receiver keeps serving.
+    """
+    from http.server import ThreadingHTTPServer
+
+    if secret is None:
+        secret = config.NOTION_WEBHOOK_SECRET
+    if fetch_pages is None:
+        from notion_api import retrieve_notion_pages as fetch_pages
+    if import_pages is None:
+        import_pages = import_pages_to_sheet
+    stop_event = stop_event or threading.Event()
+
+    events = PageEventQueue()
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_webhook_handler(events, secret))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"[Webhook] Listening on http://127.0.0.1:{server.server_address[1]}/")
+    if ready is not None:
+        ready.set()
+
+    # Imports and reconciliation share this one thread, so sheet writes never overlap
+    last_reconcile = (reconcile is not None and load_last_reconcile()) or \
+        datetime.now(timezone.utc) - timedelta(seconds=reconcile_seconds)
+    next_reconcile = time.monotonic()
+    try:
+        while not stop_event.is_set():
+            wait = 1.0 if reconcile is None else max(0.0, min(1.0, next_reconcile - time.monotonic()))
+            page_ids = events.take_batch(wait)
+            if page_ids:
+                try:
+                    pages = fetch_pages(sorted(page_ids))
+                    print(f"[Webhook] {len(page_ids)} changed pages, {len(pages)} to import.")
+                    import_pages(pages)
+                except Exception as e:
+                    print(f"[Webhook] Import of {len(page_ids)} pages failed ({e!r}); retrying in {WEBHOOK_RETRY_SECONDS}s.")
+                    events.add_many(page_ids)
+                    stop_event.wait(WEBHOOK_RETRY_SECONDS)
+
+            if reconcile is not None and time.monotonic() >= next_reconcile:
+                started = datetime.now(timezone.utc)
+                try:
+                    pages = reconcile(last_reconcile - timedelta(seconds=WEBHOOK_RECONCILE_OVERLAP))
+                    print(f"[Webhook] Reconciliation: {len(pages)} recently edited pages.")
+                    import_pages(pages[::-1])  # oldest first, like bulk_import_notion_page
+                except Exception as e:
+                    # last_reconcile stays put, so the retry covers the same window
+                    print(f"[Webhook] Reconciliation failed ({e!r}); retrying in {WEBHOOK_RETRY_SECONDS}s.")
+                    next_reconcile = time.monotonic() + min(WEBHOOK_RETRY_SECONDS, reconcile_seconds)
+                else:
+                    last_reconcile = started
+                    save_last_reconcile(started)
+                    next_reconcile = time.monotonic() + reconcile_seconds
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def send_test_event(page_id, event_type="page.created", port=WEBHOOK_PORT, secret=None):
+    """
+    Local event generator: POST a signed Notion-style event to the receiver.
+    Returns the HTTP status code.
+    """
+    import urllib.error
+    import urllib.request
+
+    if secret is None:
+        secret = config.NOTION_WEBHOOK_SECRET
+    body = json.dumps({
+        "type": event_type,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "entity": {"id": page_id, "type": "page"},
+    }).encode("utf-8")
+    request = urllib.request.Request(f"http://127.0.0.1:{port}/", data=body, method="POST", headers={
+        "Content-Type": "application/json",
+        "X-Notion-Signature": sign_notion_payload(body, secret),
+    })
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code